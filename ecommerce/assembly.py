@@ -0,0 +1,180 @@
+import logging
+import sys
+import time
+import types
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from scrapy import Request, Spider, signals
+from scrapy.exceptions import DontCloseSpider
+
+
+logger = logging.getLogger(__name__)
+
+# shared with the whole process, not held by an item
+SHARED_TYPES = (type, types.ModuleType, types.FunctionType, types.MethodType, types.BuiltinFunctionType, Spider)
+
+
+def sizeof(obj: Any, seen: Optional[set] = None) -> int:
+    """Bytes of ``obj`` and of the objects it keeps alive through containers, attributes and slots"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen or isinstance(obj, SHARED_TYPES):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(sizeof(key, seen) + sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(sizeof(value, seen) for value in obj)
+    if hasattr(obj, '__dict__'):
+        size += sizeof(vars(obj), seen)
+    for name in getattr(type(obj), '__slots__', ()):
+        size += sizeof(getattr(obj, name, None), seen)
+    return size
+
+
+class Assembly:
+    """An item waiting for the responses of its ``parts``, ``item`` is a ``ProductRecord`` or an ``ItemLoader``"""
+
+    def __init__(self, key: str, item: Any, parts: Iterable[str], **context: Any):
+        self.key = key
+        self.item = item
+        self.pending = set(parts)
+        self.missing: List[str] = []
+        self.context = context
+        self.started = time.perf_counter()
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+
+class ItemAssembler:
+    """Fan-out/fan-in of the requests completing one item.
+
+    ``start`` registers an item being filled under a key with the names of the parts it
+    waits for; the part requests, built by ``request``, only carry the key and the part name
+    in their meta, and run concurrently. The callbacks hand their fields to ``deliver`` (or
+    ``fail``), which returns the item built by ``finish`` once no part is pending. Items whose
+    parts are still pending after ``timeout`` seconds are sent with what arrived, so a slow
+    or lost part costs a field, not the product.
+
+    Every ``SAMPLE_EVERY`` item the memory held by an assembly is measured with ``sizeof``, the
+    average and the most items in flight at once are in the ``assembly/`` stats.
+    """
+    SAMPLE_EVERY = 100
+
+    def __init__(self, crawler, finish: Callable[[Assembly], Any], timeout: float = 30.0):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.finish = finish
+        self.timeout = timeout
+        self.assemblies: Dict[str, Assembly] = {}
+        self.timer = None
+        self.flushing = False
+        self.started = 0
+        self.peak = 0
+        self.sampled_bytes = []
+        crawler.signals.connect(self.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler, finish: Callable[[Assembly], Any]):
+        return cls(crawler, finish, timeout=crawler.settings.getfloat('ASSEMBLY_TIMEOUT', 30.0))
+
+    def __len__(self):
+        return len(self.assemblies)
+
+    def start(self, key: str, item: Any, parts: Iterable[str], **context: Any) -> Assembly:
+        if key in self.assemblies:
+            logger.debug('Item %s assembled again, dropping the first one', key)
+        assembly = self.assemblies[key] = Assembly(key, item, parts, **context)
+        self.peak = max(self.peak, len(self.assemblies))
+        if self.started % self.SAMPLE_EVERY == 0:
+            self.sampled_bytes.append(sizeof(assembly))
+        self.started += 1
+        if self.timer is None:
+            from twisted.internet import task
+            self.timer = task.LoopingCall(self._check)
+            self.timer.start(max(self.timeout / 4, 0.5), now=False)
+        return assembly
+
+    def request(self, key: str, part: str, url: str, callback: Callable, **kwargs: Any) -> Request:
+        """Request of one part, its callback gets the key and part name in ``response.meta``"""
+        meta = kwargs.pop('meta', {})
+        meta.update(assembly=key, part=part)
+        # a response coming after the item was sent is of no use
+        meta.setdefault('download_timeout', self.timeout)
+        return Request(url, callback, meta=meta, **kwargs)
+
+    def deliver(self, key: str, part: str, fields: Optional[Dict[str, Any]] = None) -> List:
+        """Add the ``fields`` of a part to its item, the item is returned when it was the last part"""
+        assembly = self._take(key, part)
+        if assembly is None:
+            return []
+        for name, value in (fields or {}).items():
+            if value not in (None, '', []):
+                assembly.item.add_value(name, value)
+        return self._done(assembly)
+
+    def fail(self, key: str, part: str) -> List:
+        """The part will not come, the item is returned without it when it was the last part"""
+        assembly = self._take(key, part)
+        if assembly is None:
+            return []
+        assembly.missing.append(part)
+        return self._done(assembly)
+
+    def _take(self, key: str, part: str) -> Optional[Assembly]:
+        assembly = self.assemblies.get(key)
+        if assembly is None or part not in assembly.pending:
+            self.stats.inc_value('assembly/late')
+            return None
+        assembly.pending.discard(part)
+        return assembly
+
+    def _done(self, assembly: Assembly) -> List:
+        if assembly.pending:
+            return []
+        return self._complete(assembly)
+
+    def _complete(self, assembly: Assembly) -> List:
+        self.assemblies.pop(assembly.key, None)
+        self.stats.inc_value('assembly/partial' if assembly.missing else 'assembly/complete')
+        for part in assembly.missing:
+            self.stats.inc_value(f'assembly/missing/{part}')
+        item = self.finish(assembly)
+        return [] if item is None else [item]
+
+    def expired(self) -> List[Assembly]:
+        return [assembly for assembly in self.assemblies.values() if assembly.elapsed() >= self.timeout]
+
+    def _check(self) -> None:
+        # items can only leave through a callback, an in-memory request gets one for the expired ones
+        if self.flushing or not self.expired():
+            return
+        self.flushing = True
+        self.crawler.engine.crawl(Request('data:,', self._flush, dont_filter=True, priority=100))
+
+    def _flush(self, response):
+        self.flushing = False
+        for assembly in self.expired():
+            logger.debug('Item %s timed out waiting for %s', assembly.key, ', '.join(sorted(assembly.pending)))
+            assembly.missing.extend(sorted(assembly.pending))
+            assembly.pending.clear()
+            yield from self._complete(assembly)
+
+    def spider_idle(self, spider):
+        # the pending parts may still be batched elsewhere, the timer flushes them when they expire
+        if self.assemblies:
+            raise DontCloseSpider
+
+    def bytes_per_item(self) -> Optional[int]:
+        return sum(self.sampled_bytes) // len(self.sampled_bytes) if self.sampled_bytes else None
+
+    def spider_closed(self, spider):
+        if self.timer is not None and self.timer.running:
+            self.timer.stop()
+        if self.sampled_bytes:
+            self.stats.set_value('assembly/peak_in_flight', self.peak, spider=spider)
+            self.stats.set_value('assembly/bytes_per_item', self.bytes_per_item(), spider=spider)
+        if self.assemblies:
+            logger.warning('%i items never assembled', len(self.assemblies), extra={'spider': spider})
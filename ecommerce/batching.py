@@ -0,0 +1,58 @@
+from typing import Callable, List, Optional
+
+from scrapy import Request, signals
+from scrapy.exceptions import DontCloseSpider
+
+
+class RequestBatcher:
+    """Collects keys for a short window and turns them into one multi-key request.
+
+    ``add`` returns the request as soon as the batch is full so the callback can yield
+    it; partial batches are sent to the engine when the window ends or the spider
+    goes idle.
+    """
+
+    def __init__(self, crawler, build_request: Callable[[List[str]], Request], size: int = 20,
+                 window: float = 0.5):
+        self.crawler = crawler
+        self.build_request = build_request
+        self.size = size
+        self.window = window
+        self.keys = []
+        self.timer = None
+        crawler.signals.connect(self.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    def add(self, key: str) -> Optional[Request]:
+        self.keys.append(key)
+        if len(self.keys) >= self.size:
+            return self.flush()
+        if self.timer is None:
+            from twisted.internet import reactor
+            self.timer = reactor.callLater(self.window, self._send_partial)
+        return None
+
+    def flush(self) -> Optional[Request]:
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        if not self.keys:
+            return None
+        keys, self.keys = self.keys, []
+        return self.build_request(keys)
+
+    def _send_partial(self) -> bool:
+        self.timer = None
+        request = self.flush()
+        if request is None:
+            return False
+        self.crawler.engine.crawl(request)
+        return True
+
+    def spider_idle(self, spider):
+        if self._send_partial():
+            raise DontCloseSpider
+
+    def spider_closed(self, spider):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
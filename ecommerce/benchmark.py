@@ -0,0 +1,292 @@
+import asyncio
+import inspect
+import json
+import os
+import time
+import tracemalloc
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from itemadapter import is_item
+from scrapy import Request
+from scrapy.crawler import Crawler
+from scrapy.http import HtmlResponse, TextResponse
+from scrapy.loader import ItemLoader
+
+from ecommerce.assembly import sizeof
+from ecommerce.items import Product, ProductRecord
+
+
+class FixturePage:
+    """Stands for the Playwright page of a recorded response"""
+
+    def __init__(self, url: str, html: str):
+        self.url = url
+        self.html = html
+
+    async def content(self) -> str:
+        return self.html
+
+    async def screenshot(self, **kwargs) -> bytes:
+        return b''
+
+    def is_closed(self) -> bool:
+        return False
+
+    async def close(self) -> None:
+        pass
+
+
+@dataclass
+class Scenario:
+    """One spider callback replayed on a fixture of ``BENCHMARK_DIR``"""
+    spider: str
+    callback: str
+    fixture: str
+    url: str
+    playwright: bool = False
+    # builds the request meta, and any spider state the callback expects, before each call
+    setup: Callable = field(default=lambda spider: {})
+
+    @property
+    def name(self) -> str:
+        return f'{self.spider}.{self.callback}'
+
+
+ELECLERC_URL = 'https://www.e.leclerc/fp/gravitrax-bloc-d-action-zipline-tyrolienne-4005556261581'
+ELECLERC_CATEGORY = 'NAVIGATION_circuits-billes'
+
+
+def _eleclerc_detail(spider) -> dict:
+    spider.breadcrumbs.clear()
+    spider.waiting_breadcrumb.clear()
+    spider.assembler.assemblies.clear()
+    return {'sku': '4005556261581', 'url': ELECLERC_URL}
+
+
+def _eleclerc_breadcrumb(spider) -> dict:
+    spider.assembler.start('4005556261581', ProductRecord(), ('breadcrumb',), url=ELECLERC_URL)
+    spider.waiting_breadcrumb[ELECLERC_CATEGORY] = ['4005556261581']
+    return {'codes': [ELECLERC_CATEGORY]}
+
+
+def _eleclerc_reviews(spider) -> dict:
+    spider.assembler.start('4005556261581', ProductRecord(), ('reviews',), url=ELECLERC_URL)
+    return {'assembly': '4005556261581', 'part': 'reviews'}
+
+
+SCENARIOS = [
+    Scenario('auchan', 'parse_http', 'auchan.html', 'https://www.auchan.fr/gravitrax-zipline/pr-C1028174'),
+    Scenario('auchan', 'parse', 'auchan.html', 'https://www.auchan.fr/gravitrax-zipline/pr-C1028174', True),
+    Scenario('carrefour', 'parse_http', 'carrefour.html', 'https://www.carrefour.fr/p/ketchup-heinz-0000087157215',
+             setup=lambda spider: {'gtin': '0000087157215'}),
+    Scenario('carrefour', 'parse', 'carrefour.html', 'https://www.carrefour.fr/p/ketchup-heinz-0000087157215', True,
+             setup=lambda spider: {'gtin': '0000087157215'}),
+    Scenario('joueclub', 'parse', 'joueclub.html', 'https://www.joueclub.fr/gravitrax-zipline.html', True),
+    Scenario('e-leclerc', 'parse', 'e-leclerc_detail.json', ELECLERC_URL, setup=_eleclerc_detail),
+    Scenario('e-leclerc', 'parse_breadcrumb', 'e-leclerc_categories.json', ELECLERC_URL, setup=_eleclerc_breadcrumb),
+    Scenario('e-leclerc', 'parse_reviews', 'e-leclerc_reviews.json', ELECLERC_URL, setup=_eleclerc_reviews),
+]
+
+# raw values as the spiders pass them to the Product input processors
+PROCESSOR_SAMPLES = {
+    'title': ['<h1 class="product-detail--title">\n      GraviTrax  Bloc d\'action Zipline\n    </h1>'],
+    'price': ['<div class="product-price product-price--large">12,99\xa0€</div>'],
+    'currency': ['<div class="product-price product-price--large">12,99\xa0€</div>'],
+    'description': ['<div>Le bloc d\'action <b>Zipline</b> permet à la bille de traverser le circuit.\n</div>'],
+    'breadcrumb': ['<span>Accueil</span>', '<span>Jouets</span>', '<span>Circuits à billes</span>'],
+    'ean': ['4005556261581'],
+    'review_rate': ['4.6'],
+    'review_nb': ['23'],
+}
+
+
+class FieldTimer:
+    """Adds up the time spent in the ``ItemLoader`` and ``ProductRecord`` calls of every field while active"""
+    METHODS = ((ItemLoader, 'add_xpath'), (ItemLoader, 'add_css'), (ItemLoader, 'add_value'),
+               (ProductRecord, 'add_value'))
+
+    def __init__(self):
+        self.timings = defaultdict(float)
+        self.originals = {}
+
+    def __enter__(self):
+        for cls, name in self.METHODS:
+            self.originals[(cls, name)] = getattr(cls, name)
+            setattr(cls, name, self._timed(self.originals[(cls, name)]))
+        self.originals[(ItemLoader, 'load_item')] = ItemLoader.load_item
+        setattr(ItemLoader, 'load_item', self._timed_load(ItemLoader.load_item))
+        return self
+
+    def __exit__(self, *exc_info):
+        for (cls, name), method in self.originals.items():
+            setattr(cls, name, method)
+
+    def _timed(self, method):
+        timings = self.timings
+
+        def wrapper(loader, field_name, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(loader, field_name, *args, **kwargs)
+            finally:
+                timings[field_name] += time.perf_counter() - start
+        return wrapper
+
+    def _timed_load(self, method):
+        timings = self.timings
+
+        def wrapper(loader):
+            start = time.perf_counter()
+            try:
+                return method(loader)
+            finally:
+                timings['(load_item)'] += time.perf_counter() - start
+        return wrapper
+
+
+class Benchmark:
+    """Times are the best of ``rounds`` runs of ``iterations`` calls, to keep the noise out of the comparisons"""
+
+    def __init__(self, settings, fixtures_dir: str, iterations: int = 200, rounds: int = 3,
+                 memory_iterations: int = 20):
+        self.settings = settings
+        self.fixtures_dir = fixtures_dir
+        self.iterations = iterations
+        self.rounds = rounds
+        self.memory_iterations = memory_iterations
+        self.spiders = {}
+        self.loop = None
+
+    def spider(self, spider_loader, name: str):
+        if name not in self.spiders:
+            spidercls = spider_loader.load(name)
+            crawler = Crawler(spidercls, self.settings, init_reactor=True)
+            self.spiders[name] = spidercls.from_crawler(crawler)
+            self.loop = asyncio.get_event_loop()
+        return self.spiders[name]
+
+    def response(self, scenario: Scenario, body: bytes, spider):
+        meta = scenario.setup(spider)
+        if scenario.playwright:
+            meta['playwright_page'] = FixturePage(scenario.url, body.decode('utf-8'))
+        request = Request(scenario.url, meta=meta)
+        cls = HtmlResponse if scenario.fixture.endswith('.html') else TextResponse
+        return cls(scenario.url, body=body, encoding='utf-8', request=request)
+
+    def call(self, callback, response) -> int:
+        result = callback(response)
+        if inspect.isasyncgen(result):
+            results = self.loop.run_until_complete(_collect(result))
+        else:
+            results = list(result or [])
+        return sum(1 for i in results if is_item(i))
+
+    def run_scenario(self, spider, scenario: Scenario) -> dict:
+        with open(os.path.join(self.fixtures_dir, scenario.fixture), 'rb') as f:
+            body = f.read()
+        callback = getattr(spider, scenario.callback)
+
+        elapsed, timer = None, None
+        for _ in range(self.rounds):
+            items = 0
+            with FieldTimer() as round_timer:
+                start = time.perf_counter()
+                for _ in range(self.iterations):
+                    items += self.call(callback, self.response(scenario, body, spider))
+                round_elapsed = time.perf_counter() - start
+            if elapsed is None or round_elapsed < elapsed:
+                elapsed, timer = round_elapsed, round_timer
+
+        tracemalloc.start()
+        for _ in range(self.memory_iterations):
+            self.call(callback, self.response(scenario, body, spider))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        result = {
+            'calls_per_sec': round(self.iterations / elapsed, 1),
+            'items_per_sec': round(items / elapsed, 1),
+            'fields_us': {name: round(total / self.iterations * 1e6, 1)
+                          for name, total in sorted(timer.timings.items(), key=lambda i: -i[1])},
+            'peak_kb': round(peak / 1024, 1),
+        }
+        spec = getattr(spider, 'PRODUCT_SPEC', None)
+        if spec is not None and scenario.playwright:
+            result['extraction_us'] = dict(self.profile_spec(spec, callback, scenario, body, spider))
+        assembler = getattr(spider, 'assembler', None)
+        if assembler is not None and assembler.assemblies:
+            # what a product waiting for its other requests keeps in memory
+            result['inflight_bytes'] = max(sizeof(assembly) for assembly in assembler.assemblies.values())
+        return result
+
+    def profile_spec(self, spec, callback, scenario: Scenario, body: bytes, spider) -> List[tuple]:
+        """Per field time of the single pass extraction, apart from the timed runs it would slow down"""
+        spec.profile, spec.pages = True, 0
+        spec.timings.clear()
+        try:
+            for _ in range(self.memory_iterations):
+                self.call(callback, self.response(scenario, body, spider))
+            return spec.report()
+        finally:
+            spec.profile = False
+
+    def run_processors(self) -> Dict[str, float]:
+        """Microseconds per call of every ``Product`` input processor on ``PROCESSOR_SAMPLES``"""
+        results = {}
+        for name, values in PROCESSOR_SAMPLES.items():
+            processor = Product.fields[name]['input_processor']
+            best = None
+            for _ in range(self.rounds):
+                start = time.perf_counter()
+                for _ in range(self.iterations):
+                    processor(values)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = round(best / self.iterations * 1e6, 1)
+        return results
+
+    def run(self, spider_loader, spider_names: Optional[List[str]] = None) -> dict:
+        results = {'scenarios': {}, 'processors_us': self.run_processors()}
+        for scenario in SCENARIOS:
+            if spider_names and scenario.spider not in spider_names:
+                continue
+            spider = self.spider(spider_loader, scenario.spider)
+            results['scenarios'][scenario.name] = self.run_scenario(spider, scenario)
+        return results
+
+
+async def _collect(agen) -> list:
+    return [i async for i in agen]
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Regressions of ``results`` beyond ``tolerance`` (a ratio) of the baseline"""
+    regressions = []
+    for name, result in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before and result['calls_per_sec'] < before['calls_per_sec'] * (1 - tolerance):
+            regressions.append(f'{name}: {result["calls_per_sec"]} calls/s, baseline {before["calls_per_sec"]}')
+    for name, us in results['processors_us'].items():
+        before = baseline.get('processors_us', {}).get(name)
+        if before and us > before * (1 + tolerance):
+            regressions.append(f'{name} processor: {us} us, baseline {before}')
+    return regressions
+
+
+def load_baseline(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path: str, results: dict) -> None:
+    """Store ``results`` as the baseline, keeping the scenarios of the spiders not run this time"""
+    baseline = load_baseline(path) or {}
+    baseline.setdefault('scenarios', {}).update(results['scenarios'])
+    baseline['processors_us'] = results['processors_us']
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
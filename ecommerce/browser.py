@@ -0,0 +1,158 @@
+import logging
+import queue
+import threading
+import time
+
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions
+from selenium.webdriver.support.ui import WebDriverWait
+from twisted.internet.defer import DeferredList
+from twisted.internet.threads import deferToThread, deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+
+logger = logging.getLogger(__name__)
+
+CONSENT_BUTTON = (By.ID, 'onetrust-accept-btn-handler')
+
+
+class ChromeDriverPool:
+    """Fixed set of long-lived headless Chrome drivers driven from a worker thread pool.
+
+    Every call returns a Deferred, so the spider callbacks never block the reactor
+    while a page is being loaded and captured. ``observe(stage, seconds)``, when set, is
+    called in the reactor thread with the driver startup and page load times.
+    """
+
+    def __init__(self, driver_path: str, size: int = 2, wait_timeout: float = 10,
+                 consent_timeout: float = 3, window_width: int = 1000, window_height: int = 1080):
+        self.driver_path = driver_path
+        self.size = size
+        self.wait_timeout = wait_timeout
+        self.consent_timeout = consent_timeout
+        self.window_width = window_width
+        self.window_height = window_height
+        self.drivers = queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.observe = None
+        self.threadpool = ThreadPool(minthreads=1, maxthreads=size, name='chrome-driver-pool')
+        self.threadpool.start()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            driver_path=settings.get('CHROME_DRIVER_PATH'),
+            size=settings.getint('CHROME_POOL_SIZE', 2),
+            wait_timeout=settings.getfloat('CHROME_WAIT_TIMEOUT', 10),
+            consent_timeout=settings.getfloat('CHROME_CONSENT_TIMEOUT', 3),
+        )
+
+    def screenshot(self, url: str, full_page: bool = True):
+        """Schedule a screenshot of ``url``, the Deferred fires with the PNG bytes"""
+        from twisted.internet import reactor
+        deferred = deferToThreadPool(reactor, self.threadpool, self._screenshot, url, full_page)
+        self.pending.add(deferred)
+        deferred.addBoth(self._forget, deferred)
+        return deferred
+
+    def close(self):
+        """Wait for the scheduled screenshots, then stop the workers and quit every driver"""
+        deferred = DeferredList(list(self.pending))
+        deferred.addCallback(lambda _: deferToThread(self._shutdown))
+        return deferred
+
+    def _forget(self, result, deferred):
+        self.pending.discard(deferred)
+        return result
+
+    def _shutdown(self) -> None:
+        self.threadpool.stop()
+        while True:
+            try:
+                driver = self.drivers.get_nowait()
+            except queue.Empty:
+                break
+            self._quit(driver)
+
+    def _report(self, stage: str, started: float) -> None:
+        if self.observe is not None:
+            from twisted.internet import reactor
+            reactor.callFromThread(self.observe, stage, time.perf_counter() - started)
+
+    def _create_driver(self):
+        started = time.perf_counter()
+        options = webdriver.ChromeOptions()
+        options.headless = True
+        driver = webdriver.Chrome(executable_path=self.driver_path, options=options)
+        driver.consent_accepted = False
+        self._report('selenium/startup', started)
+        return driver
+
+    def _acquire(self):
+        with self.lock:
+            if self.drivers.empty() and self.created < self.size:
+                self.created += 1
+                create = True
+            else:
+                create = False
+        if not create:
+            return self.drivers.get()
+        try:
+            return self._create_driver()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def _discard(self, driver) -> None:
+        with self.lock:
+            self.created -= 1
+        self._quit(driver)
+
+    @staticmethod
+    def _quit(driver) -> None:
+        try:
+            driver.quit()
+        except WebDriverException:
+            logger.debug('Chrome driver already gone')
+
+    def _accept_consent(self, driver) -> None:
+        if driver.consent_accepted:
+            return
+        try:
+            WebDriverWait(driver, self.consent_timeout).until(
+                expected_conditions.element_to_be_clickable(CONSENT_BUTTON)
+            ).click()
+            WebDriverWait(driver, self.wait_timeout).until(
+                expected_conditions.invisibility_of_element_located(CONSENT_BUTTON)
+            )
+        except TimeoutException:
+            logger.debug('Consent banner not found on %s', driver.current_url)
+        driver.consent_accepted = True
+
+    def _screenshot(self, url: str, full_page: bool) -> bytes:
+        driver = self._acquire()
+        try:
+            driver.set_window_size(self.window_width, self.window_height)
+            started = time.perf_counter()
+            driver.get(url)
+            WebDriverWait(driver, self.wait_timeout).until(
+                lambda d: d.execute_script('return document.readyState') == 'complete'
+            )
+            self._report('selenium/navigation', started)
+            self._accept_consent(driver)
+            if full_page:
+                height = driver.execute_script('return document.body.parentNode.scrollHeight')
+                driver.set_window_size(self.window_width, height)
+                data = driver.find_element(By.XPATH, '//body').screenshot_as_png
+            else:
+                data = driver.get_screenshot_as_png()
+        except Exception:
+            self._discard(driver)
+            raise
+        self.drivers.put(driver)
+        return data
@@ -0,0 +1,57 @@
+from scrapy.commands import ScrapyCommand
+
+from ecommerce.benchmark import Benchmark, compare, load_baseline, save_baseline
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+    default_settings = {'LOG_ENABLED': False, 'INCREMENTAL_ENABLED': False}
+
+    def syntax(self):
+        return "[options] [spider ...]"
+
+    def short_desc(self):
+        return "Replay the recorded fixtures through the spider callbacks and compare with the baseline"
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_argument("-n", "--iterations", type=int, default=200, help="calls per scenario (default: 200)")
+        parser.add_argument("-r", "--rounds", type=int, default=3, help="runs per scenario, the best is kept (default: 3)")
+        parser.add_argument("--tolerance", type=float, default=0.25,
+                            help="slowdown ratio reported as a regression (default: 0.25)")
+        parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+
+    def run(self, args, opts):
+        benchmark = Benchmark(self.settings, self.settings.get('BENCHMARK_DIR'), iterations=opts.iterations,
+                              rounds=opts.rounds)
+        results = benchmark.run(self.crawler_process.spider_loader, args)
+
+        for name, result in results['scenarios'].items():
+            inflight = f', {result["inflight_bytes"]} B per product in flight' if 'inflight_bytes' in result else ''
+            print(f'{name}: {result["calls_per_sec"]} calls/s, {result["items_per_sec"]} items/s, '
+                  f'peak {result["peak_kb"]} KB{inflight}')
+            for field_name, us in result['fields_us'].items():
+                print(f'  {field_name}: {us} us')
+            if 'extraction_us' in result:
+                print('  single pass extraction:')
+                for field_name, us in result['extraction_us'].items():
+                    print(f'    {field_name}: {us} us')
+        print('processors:')
+        for field_name, us in results['processors_us'].items():
+            print(f'  {field_name}: {us} us')
+
+        baseline_path = self.settings.get('BENCHMARK_BASELINE')
+        if opts.save_baseline:
+            save_baseline(baseline_path, results)
+            print(f'baseline saved to {baseline_path}')
+            return
+        baseline = load_baseline(baseline_path)
+        if baseline is None:
+            print(f'no baseline in {baseline_path}, run with --save-baseline to create it')
+            return
+        regressions = compare(results, baseline, opts.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            self.exitcode = 1
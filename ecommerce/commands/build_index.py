@@ -0,0 +1,16 @@
+from scrapy.commands import ScrapyCommand
+
+from ecommerce.index import build_index
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+    default_settings = {'LOG_ENABLED': False}
+
+    def short_desc(self):
+        return "Merge the exports of all spiders into the EAN price index"
+
+    def run(self, args, opts):
+        rows = build_index(self.settings.get('EXPORT_DIR'), self.settings.get('INDEX_DIR'))
+        print(f'{rows} prices indexed in {self.settings.get("INDEX_DIR")}')
@@ -0,0 +1,43 @@
+from scrapy.commands import ScrapyCommand
+from scrapy.crawler import Crawler
+from scrapy.exceptions import UsageError
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+
+    def syntax(self):
+        return "[options] [spider ...]"
+
+    def short_desc(self):
+        return "Run several spiders (all by default) in one process sharing a Playwright browser"
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_argument("--shard", metavar="i/N", help="only crawl shard i (from 0) of N of the inputs")
+        parser.add_argument("--queue", metavar="PATH", help="work as one of the workers of a shared queue")
+
+    def process_options(self, args, opts):
+        ScrapyCommand.process_options(self, args, opts)
+        if opts.shard:
+            self.settings.set('START_SHARD', opts.shard, priority='cmdline')
+        if opts.queue:
+            self.settings.set('WORK_QUEUE', opts.queue, priority='cmdline')
+
+    def run(self, args, opts):
+        spider_loader = self.crawler_process.spider_loader
+        names = args or sorted(spider_loader.list())
+        unknown = set(names) - set(spider_loader.list())
+        if unknown:
+            raise UsageError(f"Unknown spiders: {', '.join(sorted(unknown))}", print_help=False)
+
+        share = max(1, self.settings.getint('CRAWLALL_CONCURRENT_REQUESTS') // len(names))
+        for name in names:
+            settings = self.settings.copy()
+            settings.set('CONCURRENT_REQUESTS', share, priority='cmdline')
+            crawler = Crawler(spider_loader.load(name), settings, init_reactor=True)
+            self.crawler_process.crawl(crawler)
+        self.crawler_process.start()
+        if self.crawler_process.bootstrap_failed:
+            self.exitcode = 1
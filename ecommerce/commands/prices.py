@@ -0,0 +1,36 @@
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from ecommerce.index import PriceIndex
+from ecommerce.normalize import ean13
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+    default_settings = {'LOG_ENABLED': False}
+
+    def syntax(self):
+        return "[options] <ean> ..."
+
+    def short_desc(self):
+        return "Show the prices of products by retailer from the EAN price index"
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_argument("--week", metavar="YYYY-Www", help="ISO week to show (default: latest)")
+
+    def run(self, args, opts):
+        if not args:
+            raise UsageError()
+        index = PriceIndex(self.settings.get('INDEX_DIR'))
+        for ean in (ean13(ean) or ean for ean in args):
+            price_range = index.price_range(ean, opts.week)
+            if price_range is None:
+                print(f'{ean}: not found')
+                continue
+            deltas = index.deltas(ean, opts.week)
+            print(f'{ean} ({opts.week or index.latest_week(ean)}): min {price_range[0]} max {price_range[1]}')
+            for spider, price in index.by_retailer(ean, opts.week).items():
+                delta = f' ({deltas[spider]:+})' if spider in deltas else ''
+                print(f'  {spider}: {price}{delta}')
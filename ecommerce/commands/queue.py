@@ -0,0 +1,51 @@
+from types import SimpleNamespace
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from ecommerce.inputs import start_records
+from ecommerce.workqueue import WorkQueue
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+    default_settings = {'LOG_ENABLED': False}
+
+    def syntax(self):
+        return "[options] seed [spider ...] | status"
+
+    def short_desc(self):
+        return "Load the inputs of spiders (all by default) into the WORK_QUEUE of distributed workers, or count it"
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_argument("--queue", metavar="PATH", help="queue file (default: WORK_QUEUE setting)")
+        parser.add_argument("--input", metavar="FILE", help="input of the only spider seeded (default: START_INPUTS)")
+
+    def run(self, args, opts):
+        path = opts.queue or self.settings.get('WORK_QUEUE')
+        if not args or args[0] not in ('seed', 'status') or not path:
+            raise UsageError()
+        queue = WorkQueue(path, max_attempts=self.settings.getint('WORK_QUEUE_MAX_ATTEMPTS', 3))
+        if args[0] == 'seed':
+            self.seed(queue, args[1:], opts.input)
+        for spider, counts in queue.counts().items():
+            print(f'{spider}: ' + ', '.join(f'{count} {status}' for status, count in sorted(counts.items())))
+        queue.close()
+
+    def seed(self, queue, names, input_path):
+        spider_loader = self.crawler_process.spider_loader
+        names = names or sorted(spider_loader.list())
+        unknown = set(names) - set(spider_loader.list())
+        if unknown:
+            raise UsageError(f"Unknown spiders: {', '.join(sorted(unknown))}", print_help=False)
+        if input_path and len(names) > 1:
+            raise UsageError("--input needs a single spider", print_help=False)
+        for name in names:
+            # the records a crawl of the spider would start from, inputs and shard included
+            spidercls = spider_loader.load(name)
+            spider = SimpleNamespace(name=name, settings=self.settings, start_urls=spidercls.start_urls,
+                                     input=input_path)
+            added = queue.enqueue(name, start_records(spider))
+            print(f'{name}: {added} products queued')
@@ -0,0 +1,176 @@
+import logging
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+from lxml import etree
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+
+logger = logging.getLogger(__name__)
+
+# plain elements, the HtmlElement class lookup of lxml.html costs more than the tests of a field
+HTML_PARSER = etree.HTMLParser(remove_comments=True, huge_tree=True)
+
+
+def outer_html(element) -> str:
+    """The element as ``Selector.get()`` returns it, for the ``remove_tags`` input processors"""
+    return etree.tostring(element, method='html', encoding='unicode', with_tail=False)
+
+
+def own_text(element) -> List[str]:
+    """The text nodes directly under the element, like ``text()``"""
+    return [text for text in [element.text, *(child.tail for child in element)] if text]
+
+
+class Match:
+    """Element test standing for one XPath step, e.g. ``//div[contains(@class, "price")]/span``
+    is ``Match('span', parent=Match('div', contains={'class': 'price'}))``.
+
+    ``ancestor`` stands for a ``//`` between two steps.
+    """
+
+    def __init__(self, tag: str = '*', equals: Optional[Dict[str, str]] = None,
+                 contains: Optional[Dict[str, str]] = None, parent: Optional['Match'] = None,
+                 ancestor: Optional['Match'] = None):
+        self.tag = tag
+        self.equals = list((equals or {}).items())
+        self.contains = list((contains or {}).items())
+        self.parent = parent
+        self.ancestor = ancestor
+
+    def __call__(self, element) -> bool:
+        if self.tag != '*' and element.tag != self.tag:
+            return False
+        for name, value in self.equals:
+            if element.get(name) != value:
+                return False
+        for name, value in self.contains:
+            if value not in element.get(name, ''):
+                return False
+        if self.parent is not None:
+            parent = element.getparent()
+            if parent is None or not self.parent(parent):
+                return False
+        if self.ancestor is not None:
+            ancestors = element.iterancestors() if self.ancestor.tag == '*' else \
+                element.iterancestors(self.ancestor.tag)
+            return any(self.ancestor(ancestor) for ancestor in ancestors)
+        return True
+
+
+class FieldSpec:
+    """Where a ``Product`` field is on the page.
+
+    ``extract`` turns a matching element into values, ``outer_html`` by default; an empty
+    result means the element did not hold the field after all. Unless ``many`` is set the
+    field is done with its first match, like the ``TakeFirst`` output processors.
+    """
+
+    def __init__(self, name: str, match: Match, extract: Callable = outer_html, many: bool = False):
+        self.name = name
+        self.match = match
+        self.extract = extract
+        self.many = many
+
+    def values(self, element) -> List[str]:
+        values = self.extract(element)
+        if values is None:
+            return []
+        return values if isinstance(values, list) else [values]
+
+
+class ProductSpec:
+    """The fields of one retailer page, all extracted in a single walk of the lxml tree.
+
+    Specs are built at import time and the fields are indexed by tag, so the walk only stops
+    on the tags of the fields and tests each element against the fields that can match it.
+    With ``profile`` set the time spent testing and extracting is added up per field in
+    ``timings``, over ``pages`` pages.
+    """
+
+    def __init__(self, *fields: FieldSpec, profile: bool = False):
+        self.fields = fields
+        by_tag = defaultdict(list)
+        for spec in fields:
+            by_tag[spec.match.tag].append(spec)
+        self.any_tag = by_tag.pop('*', [])
+        self.by_tag = {tag: specs + self.any_tag for tag, specs in by_tag.items()}
+        # lxml skips the other elements in C, unless a field can be any element
+        self.tags = () if self.any_tag else tuple(self.by_tag)
+        self.profile = profile
+        self.timings = defaultdict(float)
+        self.pages = 0
+
+    def extract(self, html: str) -> Dict[str, List[str]]:
+        root = etree.fromstring(html or '<html></html>', HTML_PARSER)
+        found = {}
+        pending = len([spec for spec in self.fields if not spec.many])
+        many = any(spec.many for spec in self.fields)
+        timings = None
+        if self.profile:
+            timings = self.timings
+            self.pages += 1
+        for element in root.iter(*self.tags or (etree.Element,)):
+            for spec in self.by_tag.get(element.tag, self.any_tag):
+                if not spec.many and spec.name in found:
+                    continue
+                start = time.perf_counter() if timings is not None else 0
+                values = spec.values(element) if spec.match(element) else None
+                if timings is not None:
+                    timings[spec.name] += time.perf_counter() - start
+                if not values:
+                    continue
+                if spec.many:
+                    found.setdefault(spec.name, []).extend(values)
+                else:
+                    found[spec.name] = values
+                    pending -= 1
+            if not pending and not many:
+                break
+        return found
+
+    def populate(self, item, html: str) -> Dict[str, List[str]]:
+        """Extract the fields of ``html`` and add them to ``item``, a ``ProductRecord`` or an ``ItemLoader``"""
+        found = self.extract(html)
+        for name, values in found.items():
+            item.add_value(name, values)
+        return found
+
+    def report(self) -> List[tuple]:
+        """``(field, microseconds per page)``, slowest first"""
+        pages = self.pages or 1
+        return sorted(((name, round(total / pages * 1e6, 1)) for name, total in self.timings.items()),
+                      key=lambda i: -i[1])
+
+
+class ExtractionProfile:
+    """Turns on the profiling of the spider ``PRODUCT_SPEC`` and logs the slowest fields when it closes"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('EXTRACTION_PROFILE'):
+            raise NotConfigured
+        extension = cls(crawler.stats)
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        spec = getattr(spider, 'PRODUCT_SPEC', None)
+        if spec is not None:
+            spec.profile = True
+
+    def spider_closed(self, spider):
+        spec = getattr(spider, 'PRODUCT_SPEC', None)
+        if spec is None or not spec.pages:
+            return
+        report = spec.report()
+        for name, us in report:
+            self.stats.set_value(f'extraction/{name}_us', us, spider=spider)
+        logger.info('Extraction time per page over %i pages: %s', spec.pages,
+                    ', '.join(f'{name} {us}us' for name, us in report), extra={'spider': spider})
@@ -0,0 +1,276 @@
+import asyncio
+import logging
+import weakref
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+from playwright.async_api import Browser, BrowserContext, Error as PlaywrightError, Page, PlaywrightContextManager
+from playwright.async_api import Request as PlaywrightRequest
+from scrapy import Spider
+from scrapy.http import Request, Response
+from scrapy_playwright.handler import ScrapyPlaywrightDownloadHandler
+
+from ecommerce.resources import PageResources, load_profiles, site_of
+
+
+logger = logging.getLogger(__name__)
+
+# evaluated in a page, the JS heap it uses (Chromium only, 0 elsewhere)
+HEAP_SIZE = 'performance.memory ? performance.memory.usedJSHeapSize : 0'
+# evaluated in a page with a selector, clicks the element if there is one
+CLICK = 'selector => { const button = document.querySelector(selector); if (button) button.click(); return !!button }'
+
+
+class PagePool:
+    """Open pages of the shared browser waiting, by context, for the next request of their context.
+
+    A page comes back through ``put`` once its response, item and screenshot are done with it,
+    and is blanked and kept unless it was used ``max_uses`` times or its JS heap grew past
+    ``max_heap`` bytes, then it is closed so a fresh one replaces it. Reusing a page saves its
+    creation and the setup of its handlers and routes, and keeps what the site stored in it.
+    """
+
+    def __init__(self, max_uses: int = 50, max_heap: int = 0):
+        self.max_uses = max_uses
+        self.max_heap = max_heap
+        self.idle: Dict[BrowserContext, List[Page]] = {}
+        self.uses: Dict[Page, int] = {}
+        self.owners: Dict[Page, 'SharedBrowserDownloadHandler'] = {}
+
+    def __len__(self):
+        return sum(len(pages) for pages in self.idle.values())
+
+    def adopt(self, page: Page, owner: 'SharedBrowserDownloadHandler') -> None:
+        self.uses[page] = 0
+        self.owners[page] = owner
+        page.on('close', lambda: self.forget(page))
+
+    def forget(self, page: Page) -> None:
+        pages = self.idle.get(page.context, [])
+        if page in pages:
+            pages.remove(page)
+            self._count_idle(page, -1)
+        self.uses.pop(page, None)
+        self.owners.pop(page, None)
+
+    def take(self, context: BrowserContext) -> Optional[Page]:
+        pages = self.idle.get(context)
+        while pages:
+            page = pages.pop()
+            self._count_idle(page, -1)
+            if not page.is_closed():
+                return page
+        return None
+
+    def _count_idle(self, page: Page, change: int) -> None:
+        # the pages left in the pool are still open when the spider closes, but not leaked
+        owner = self.owners.get(page)
+        if owner is not None:
+            owner.stats.inc_value('playwright/pages/idle', change)
+
+    async def put(self, page: Page) -> bool:
+        """Keep the page for the next request of its context, False if it was not kept and should close"""
+        if page.is_closed() or page not in self.uses:
+            return False
+        self.uses[page] += 1
+        owner = self.owners[page]
+        owner.report_resources(page)
+        stats = owner.stats
+        if self.uses[page] >= self.max_uses:
+            stats.inc_value('playwright/page_pool/recycled/uses')
+            return False
+        try:
+            if self.max_heap and await page.evaluate(HEAP_SIZE) > self.max_heap:
+                stats.inc_value('playwright/page_pool/recycled/memory')
+                return False
+            # stops the scripts of the product page while it waits
+            await page.goto('about:blank')
+        except PlaywrightError:
+            return False
+        self.idle.setdefault(page.context, []).append(page)
+        self._count_idle(page, 1)
+        return True
+
+    async def evict(self, pages: asyncio.Semaphore) -> None:
+        """Close an idle page when the ``PLAYWRIGHT_MAX_PAGES`` are open, a new page waits for its slot"""
+        if not pages.locked():
+            return
+        waiting = next((idle for idle in self.idle.values() if idle), None)
+        if waiting is not None:
+            page = waiting.pop(0)
+            self._count_idle(page, -1)
+            self.owners[page].stats.inc_value('playwright/page_pool/evicted')
+            await page.close()
+
+
+async def release_page(page: Page) -> None:
+    """Give back the page of a ``playwright_include_page`` request once done with it, pooled or closed"""
+    pool = SharedBrowserDownloadHandler.shared_pool
+    if pool is None or not await pool.put(page):
+        if not page.is_closed():
+            await page.close()
+
+
+class SharedBrowserDownloadHandler(ScrapyPlaywrightDownloadHandler):
+    """Playwright download handler sharing one browser between all the crawlers of the process.
+
+    Each crawler keeps its own contexts, named after the request domain unless the
+    request sets ``playwright_context``, and ``PLAYWRIGHT_MAX_PAGES`` caps the pages open
+    in the shared browser whatever spider they belong to.
+
+    Sub-resources are filtered by the ``ResourceProfile`` named in the
+    ``playwright_resource_profile`` meta key, "screenshot" by default or "extract" when
+    ``SCREENSHOT_ENABLED`` is off.
+
+    Pages given back with ``release_page`` go to the ``PagePool`` and serve the next requests
+    of their context, see ``PLAYWRIGHT_PAGE_MAX_USES``; a page whose download failed is closed
+    here, whether the request wanted it or not. The element of the ``playwright_consent``
+    selector, a cookie banner button, is clicked on the first page of a context that has it,
+    the context keeps the consent cookies for the pages after it.
+    """
+    shared_lock: Optional[asyncio.Lock] = None
+    shared_manager: Optional[PlaywrightContextManager] = None
+    shared_playwright = None
+    shared_browser: Optional[Browser] = None
+    shared_pages: Optional[asyncio.Semaphore] = None
+    shared_pool: Optional[PagePool] = None
+    users = 0
+
+    def __init__(self, crawler) -> None:
+        super().__init__(crawler)
+        settings = crawler.settings
+        self.max_pages = settings.getint('PLAYWRIGHT_MAX_PAGES', 16)
+        self.resource_profiles = load_profiles(settings)
+        self.default_resource_profile = settings.get('PLAYWRIGHT_RESOURCE_PROFILE') or (
+            'screenshot' if settings.getbool('SCREENSHOT_ENABLED', True) else 'extract'
+        )
+        self.max_page_uses = settings.getint('PLAYWRIGHT_PAGE_MAX_USES', 50)
+        self.max_page_heap = settings.getint('PLAYWRIGHT_PAGE_MAX_HEAP_MB', 256) * 1024 * 1024
+        self.page_resources = {}
+        self.consented = weakref.WeakSet()
+        self.abort_request = self._abort_resource
+
+    @classmethod
+    def _get_lock(cls) -> asyncio.Lock:
+        if cls.shared_lock is None:
+            cls.shared_lock = asyncio.Lock()
+        return cls.shared_lock
+
+    async def _launch(self) -> None:
+        cls = SharedBrowserDownloadHandler
+        async with self._get_lock():
+            if cls.shared_playwright is None:
+                cls.shared_manager = PlaywrightContextManager()
+                cls.shared_playwright = await cls.shared_manager.start()
+                cls.shared_pages = asyncio.Semaphore(self.max_pages)
+                cls.shared_pool = PagePool(self.max_page_uses, self.max_page_heap)
+            cls.users += 1
+        self.playwright_context_manager = cls.shared_manager
+        self.playwright = cls.shared_playwright
+        self.browser_type = getattr(self.playwright, self.browser_type_name)
+        if self.context_kwargs:
+            await asyncio.gather(
+                *[
+                    self._create_browser_context(name=name, context_kwargs=kwargs)
+                    for name, kwargs in self.context_kwargs.items()
+                ]
+            )
+
+    async def _maybe_launch_browser(self) -> None:
+        cls = SharedBrowserDownloadHandler
+        async with self._get_lock():
+            if cls.shared_browser is None:
+                cls.shared_browser = await self.browser_type.launch(**self.launch_options)
+        self.browser = cls.shared_browser
+
+    async def _create_page(self, request: Request) -> Page:
+        cls = SharedBrowserDownloadHandler
+        context = self.contexts.get(request.meta.setdefault('playwright_context', urlparse(request.url).netloc))
+        page = cls.shared_pool.take(context.context) if context is not None else None
+        if page is not None:
+            self.stats.inc_value('playwright/page_pool/reused')
+            self._track_resources(page, request)
+            return page
+        pages = cls.shared_pages
+        await cls.shared_pool.evict(pages)
+        await pages.acquire()
+        try:
+            page = await super()._create_page(request)
+        except Exception:
+            pages.release()
+            raise
+        page.on('close', lambda: pages.release())
+        # playwright/page_count/closed only counts the pages scrapy-playwright closes itself
+        page.on('close', lambda: self.stats.inc_value('playwright/pages/closed'))
+        cls.shared_pool.adopt(page, self)
+        page.on('response', lambda response: self._on_response(page, response))
+        page.on('close', lambda: self.report_resources(page))
+        self._track_resources(page, request)
+        return page
+
+    async def _download_request(self, request: Request, spider: Spider) -> Response:
+        try:
+            return await super()._download_request(request, spider)
+        except Exception:
+            # the page is left in an unknown state, and an errback may not be there to close it
+            page = request.meta.pop('playwright_page', None)
+            if isinstance(page, Page) and not page.is_closed():
+                await page.close()
+                self.stats.inc_value('playwright/page_count/closed')
+            raise
+
+    async def _apply_page_methods(self, page: Page, request: Request) -> None:
+        selector = request.meta.get('playwright_consent')
+        if selector and page.context not in self.consented and await page.evaluate(CLICK, selector):
+            self.consented.add(page.context)
+            await page.wait_for_load_state(timeout=self.default_navigation_timeout)
+        await super()._apply_page_methods(page, request)
+
+    def _track_resources(self, page: Page, request: Request) -> None:
+        profile_name = request.meta.get('playwright_resource_profile', self.default_resource_profile)
+        self.page_resources[page] = PageResources(self.resource_profiles.get(profile_name), site_of(request.url))
+
+    def _on_response(self, page: Page, response) -> None:
+        resources = self.page_resources.get(page)
+        if resources is not None:
+            resources.on_response(response)
+
+    def report_resources(self, page: Page) -> None:
+        resources = self.page_resources.pop(page, None)
+        if resources is None:
+            return
+        blocked = sum(resources.blocked.values())
+        self.stats.inc_value('playwright/resources/bytes_loaded', resources.bytes_loaded)
+        logger.debug(
+            'Page %s (%s profile): %i of %i requests blocked (%s), %i bytes loaded',
+            page.url, resources.profile.name if resources.profile else 'no', blocked, blocked + resources.requests,
+            dict(resources.blocked), resources.bytes_loaded,
+        )
+
+    def _abort_resource(self, request: PlaywrightRequest) -> bool:
+        try:
+            resources = self.page_resources.get(request.frame.page)
+        except Exception:
+            return False
+        if resources is None:
+            return False
+        if resources.profile is None or not resources.profile.blocks(request, resources.site):
+            resources.requests += 1
+            return False
+        resources.blocked[request.resource_type] += 1
+        self.stats.inc_value(f'playwright/resources/blocked/{request.resource_type}')
+        return True
+
+    async def _close(self) -> None:
+        cls = SharedBrowserDownloadHandler
+        await asyncio.gather(*[ctx.context.close() for ctx in self.contexts.values()])
+        self.contexts.clear()
+        async with self._get_lock():
+            cls.users -= 1
+            if cls.users > 0:
+                return
+            if cls.shared_browser is not None:
+                await cls.shared_browser.close()
+            await cls.shared_manager.__aexit__()
+            cls.shared_browser = cls.shared_manager = cls.shared_playwright = None
+            cls.shared_pages = cls.shared_pool = None
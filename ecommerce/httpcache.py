@@ -0,0 +1,101 @@
+import logging
+import os
+import re
+import sqlite3
+import time
+import zlib
+from typing import List, Optional, Pattern, Tuple
+
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from scrapy.utils.request import request_fingerprint
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+
+
+logger = logging.getLogger(__name__)
+
+
+class EndpointCacheStorage:
+    """``HTTPCACHE_STORAGE`` keeping the responses of the retailer JSON APIs in one SQLite file per spider.
+
+    Only the urls matching a pattern of ``HTTPCACHE_TTLS`` are stored, each for the seconds of its
+    first matching pattern, so category details can last for weeks while prices expire within
+    hours; pages, Playwright and conditional requests always go to the retailer, and a 304 is
+    never kept, it only stands for the validators it was asked with. Bodies are zlib compressed
+    and the file is memory-mapped, a rerun after a crash reads the API calls of the first run
+    back instead of downloading them again.
+    """
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.rules: List[Tuple[Pattern, float]] = [
+            (re.compile(pattern), float(ttl)) for pattern, ttl in settings.getdict('HTTPCACHE_TTLS').items()
+        ]
+        self.compression = settings.getint('HTTPCACHE_COMPRESSION_LEVEL', 6)
+        self.mmap_size = settings.getint('HTTPCACHE_MMAP_SIZE', 256 * 1024 * 1024)
+        self.commit_every = settings.getint('HTTPCACHE_COMMIT_EVERY', 100)
+        self.uncommitted = 0
+        self.db = None
+
+    def open_spider(self, spider):
+        self.db = sqlite3.connect(os.path.join(self.cachedir, f'{spider.name}.sqlite'))
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(f'PRAGMA mmap_size={self.mmap_size}')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'fingerprint TEXT PRIMARY KEY, url TEXT, status INTEGER, headers BLOB, body BLOB, '
+            'stored_at REAL, expires_at REAL)'
+        )
+        purged = self.db.execute('DELETE FROM responses WHERE expires_at < ?', (time.time(),)).rowcount
+        self.db.commit()
+        logger.debug('HTTP cache of %s opened, %i expired responses purged', spider.name, purged,
+                     extra={'spider': spider})
+
+    def close_spider(self, spider):
+        self.db.commit()
+        self.db.close()
+        self.db = None
+
+    def ttl(self, url: str) -> Optional[float]:
+        for pattern, ttl in self.rules:
+            if pattern.search(url):
+                return ttl
+        return None
+
+    def cached(self, request) -> Optional[float]:
+        """TTL of the request responses, None if it is not cached"""
+        if request.meta.get('playwright') or request.meta.get('conditional'):
+            return None
+        return self.ttl(request.url)
+
+    def retrieve_response(self, spider, request):
+        if self.cached(request) is None:
+            return None
+        row = self.db.execute(
+            'SELECT url, status, headers, body FROM responses WHERE fingerprint = ? AND expires_at >= ? '
+            'AND status != 304',
+            (request_fingerprint(request), time.time()),
+        ).fetchone()
+        if row is None:
+            return None
+        url, status, raw_headers, body = row
+        headers = Headers(headers_raw_to_dict(raw_headers))
+        body = zlib.decompress(body)
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(self, spider, request, response):
+        ttl = self.cached(request)
+        if ttl is None or response.status == 304:
+            return
+        now = time.time()
+        self.db.execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (request_fingerprint(request), response.url, response.status, headers_dict_to_raw(response.headers),
+             zlib.compress(response.body, self.compression), now, now + ttl),
+        )
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.db.commit()
+            self.uncommitted = 0
@@ -0,0 +1,96 @@
+import glob
+import os
+from typing import Dict, Optional, Tuple
+
+import pandas as pd
+import pyarrow.dataset
+
+from ecommerce.normalize import ean13
+
+
+PRICES_FILE = 'prices.parquet'
+SUMMARY_FILE = 'summary.parquet'
+
+
+COLUMNS = ['ean', 'ean13', 'title', 'price', 'price_cents', 'spider', 'date']
+
+
+def load_exports(export_dir: str) -> pd.DataFrame:
+    """Read the Parquet partitions written by ``ExportPipeline`` for every spider and crawl date"""
+    files = glob.glob(os.path.join(export_dir, '**', '*.parquet'), recursive=True)
+    if not files:
+        return pd.DataFrame(columns=COLUMNS)
+    dataset = pyarrow.dataset.dataset(
+        files, format='parquet', partitioning='hive', partition_base_dir=export_dir
+    )
+    # the exports written before the typed columns read them as nulls
+    dataset = dataset.replace_schema(pyarrow.unify_schemas(
+        [dataset.schema] + [fragment.physical_schema for fragment in dataset.get_fragments()]
+    ))
+    columns = [name for name in COLUMNS if name in dataset.schema.names]
+    return dataset.to_table(columns=columns).to_pandas().reindex(columns=COLUMNS)
+
+
+def build_index(export_dir: str, index_dir: str) -> int:
+    """Merge the exports of all spiders into an EAN keyed price index, return the number of rows"""
+    frame = load_exports(export_dir)
+    # typed columns where the export has them, the scraped strings otherwise
+    frame['price'] = (frame['price_cents'].astype('Float64') / 100).fillna(
+        pd.to_numeric(frame['price'], errors='coerce')).astype(float)
+    frame['ean'] = frame['ean13'].fillna(frame['ean'].map(ean13, na_action='ignore')).fillna(frame['ean'])
+    frame = frame.dropna(subset=['ean', 'price'])
+    frame['date'] = pd.to_datetime(frame['date'].astype(str))
+    frame['week'] = frame['date'].dt.strftime('%G-W%V')
+    # the last crawl of a week wins, then each retailer price is compared to its previous week
+    frame = frame.sort_values('date').drop_duplicates(['ean', 'spider', 'week'], keep='last')
+    frame = frame.sort_values(['ean', 'spider', 'week'])
+    frame['delta'] = frame.groupby(['ean', 'spider'], sort=False)['price'].diff().round(2)
+    prices = frame[['ean', 'week', 'spider', 'title', 'price', 'delta']].sort_values(['ean', 'week', 'spider'])
+    summary = prices.groupby(['ean', 'week'])['price'].agg(['min', 'max', 'count']).reset_index()
+
+    os.makedirs(index_dir, exist_ok=True)
+    prices.to_parquet(os.path.join(index_dir, PRICES_FILE), index=False)
+    summary.to_parquet(os.path.join(index_dir, SUMMARY_FILE), index=False)
+    return len(prices)
+
+
+class PriceIndex:
+    """Lookups on the index written by ``build_index``, backed by sorted (ean, week, ...) indexes"""
+
+    def __init__(self, index_dir: str):
+        prices = pd.read_parquet(os.path.join(index_dir, PRICES_FILE))
+        self.prices = prices.set_index(['ean', 'week', 'spider']).sort_index()
+        summary = pd.read_parquet(os.path.join(index_dir, SUMMARY_FILE))
+        self.summary = summary.set_index(['ean', 'week']).sort_index()
+
+    def latest_week(self, ean: str) -> Optional[str]:
+        try:
+            return self.summary.loc[ean].index[-1]
+        except KeyError:
+            return None
+
+    def _week(self, ean: str, week: Optional[str]) -> Optional[str]:
+        return week or self.latest_week(ean)
+
+    def by_retailer(self, ean: str, week: Optional[str] = None) -> Dict[str, float]:
+        week = self._week(ean, week)
+        try:
+            return self.prices.loc[(ean, week), 'price'].to_dict()
+        except KeyError:
+            return {}
+
+    def price_range(self, ean: str, week: Optional[str] = None) -> Optional[Tuple[float, float]]:
+        week = self._week(ean, week)
+        try:
+            row = self.summary.loc[(ean, week)]
+        except KeyError:
+            return None
+        return row['min'], row['max']
+
+    def deltas(self, ean: str, week: Optional[str] = None) -> Dict[str, float]:
+        """Price change of each retailer since its previous crawled week"""
+        week = self._week(ean, week)
+        try:
+            return self.prices.loc[(ean, week), 'delta'].dropna().to_dict()
+        except KeyError:
+            return {}
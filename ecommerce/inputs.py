@@ -0,0 +1,65 @@
+import csv
+import gzip
+import json
+import zlib
+from typing import Dict, Iterator, Optional, Tuple
+
+from ecommerce.workqueue import leased_records
+
+
+def open_text(path: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def iter_records(path: str) -> Iterator[Dict[str, str]]:
+    """Lazily read ``{'url': ..., 'ean': ...}`` records from a CSV, JSONL or one-url-per-line file, gzipped or not"""
+    name = path[:-3] if path.endswith('.gz') else path
+    with open_text(path) as f:
+        if name.endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield {key.strip().lower(): value.strip() for key, value in row.items() if key and value}
+        elif name.endswith(('.jsonl', '.ndjson')):
+            for line in f:
+                if line.strip():
+                    yield {key.strip().lower(): value for key, value in json.loads(line).items()}
+        else:
+            for line in f:
+                if line.strip():
+                    yield {'url': line.strip()}
+
+
+def parse_shard(value: Optional[str]) -> Optional[Tuple[int, int]]:
+    """``"i/N"`` to ``(i, N)``, shards are numbered from 0"""
+    if not value:
+        return None
+    index, count = (int(part) for part in value.split('/'))
+    if not 0 <= index < count:
+        raise ValueError(f'Invalid shard {value}, expected i/N with 0 <= i < N')
+    return index, count
+
+
+def in_shard(record: Dict[str, str], shard: Tuple[int, int]) -> bool:
+    index, count = shard
+    return zlib.crc32(record['url'].encode()) % count == index
+
+
+def start_records(spider) -> Iterator[Dict[str, str]]:
+    """Records of the spider ``input`` argument (or its ``START_INPUTS`` entry), else its ``start_urls``.
+
+    Only the records of the ``shard`` argument (or ``START_SHARD``) are kept, so several
+    processes can split one input by url hash. A worker of a ``WORK_QUEUE`` reads its records
+    from the queue instead.
+    """
+    if getattr(spider, 'work_queue', None) is not None:
+        yield from leased_records(spider)
+        return
+    path = getattr(spider, 'input', None) or spider.settings.getdict('START_INPUTS').get(spider.name)
+    shard = parse_shard(getattr(spider, 'shard', None) or spider.settings.get('START_SHARD'))
+    records = iter_records(path) if path else ({'url': url} for url in spider.start_urls)
+    for record in records:
+        if not record.get('url'):
+            continue
+        if shard is None or in_shard(record, shard):
+            yield record
@@ -2,17 +2,23 @@
 #
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/items.html
+import sys
+from dataclasses import dataclass
+from typing import Any, Optional
+
 import scrapy
 
 from itemloaders.processors import TakeFirst, MapCompose, Join
 from w3lib.html import remove_tags
 
+from ecommerce.normalize import currency_code
+
+
+SYMBOLS = str.maketrans({'\xa0': None, '€': None, '$': None, ',': '.'})
+
 
 def remove_symbols(value: str) -> str:
-    symbols = ['\xa0', '€', '$']
-    for symbol in symbols:
-        value = value.replace(symbol, '')
-    return value.replace(',', '.')
+    return value.translate(SYMBOLS)
 
 
 def remove_n(value: str) -> str:
@@ -24,13 +30,29 @@ def remove_strs(value: str) -> str:
     return ''.join([i for i in value if i.isdigit()])
 
 
+def to_integer(value: str) -> str:
+    """``'0004005556261581'``, ``' 23 '`` or ``'23.0'`` as ``str(int(float(value)))`` gives it, without the floats"""
+    digits = value.strip().split('.', 1)[0]
+    if not digits.isdigit():
+        raise ValueError(f'Not an integer: {value!r}')
+    return digits.lstrip('0') or '0'
+
+
+@dataclass
+class ScreenshotJob:
+    """Screenshot left to ``ScreenshotPipeline``, either of an open Playwright page or of an url"""
+    name: str
+    page: Any = None
+    url: Optional[str] = None
+
+
 class Product(scrapy.Item):
     link = scrapy.Field(
         input_processor=MapCompose(),
         output_processor=TakeFirst(),
     )
     ean = scrapy.Field(
-        input_processor=MapCompose(remove_tags, float, int, str),
+        input_processor=MapCompose(remove_tags, to_integer),
         output_processor=TakeFirst(),
     )
     title = scrapy.Field(
@@ -41,6 +63,10 @@ class Product(scrapy.Item):
         input_processor=MapCompose(remove_tags, remove_n, remove_symbols),
         output_processor=TakeFirst()
     )
+    currency = scrapy.Field(
+        input_processor=MapCompose(remove_tags, currency_code),
+        output_processor=TakeFirst()
+    )
     description = scrapy.Field(
         input_processor=MapCompose(remove_tags, remove_n),
         output_processor=TakeFirst()
@@ -54,10 +80,72 @@ class Product(scrapy.Item):
         output_processor=TakeFirst()
     )
     review_nb = scrapy.Field(
-        input_processor=MapCompose(remove_tags, float, int, str),
+        input_processor=MapCompose(remove_tags, to_integer),
         output_processor=TakeFirst()
     )
     screenshot = scrapy.Field(
         input_processor=MapCompose(),
         output_processor=TakeFirst()
     )
+
+
+class ProductUnchanged(scrapy.Item):
+    """Emitted instead of ``Product`` when the product did not change since the previous run"""
+    link = scrapy.Field()
+    ean = scrapy.Field()
+
+
+# Product processors by field, applied by ProductRecord without an ItemLoader
+PROCESSORS = {name: (field['input_processor'], field['output_processor']) for name, field in Product.fields.items()}
+
+
+@dataclass(init=False)
+class ProductRecord:
+    """``Product`` in fixed slots, filled by the spiders without an ``ItemLoader``.
+
+    ``add_value`` runs the ``Product`` processors on a value as it comes, so only the final
+    values are kept: a record weighs a few hundred bytes where a loader and its item weigh
+    several kilobytes. Breadcrumbs are interned, a category path repeats over all its products.
+    ``work_key``, the lease of the product in a ``WORK_QUEUE``, is no field and is not exported.
+    """
+    __slots__ = ('link', 'ean', 'title', 'price', 'currency', 'description', 'breadcrumb', 'review_rate',
+                 'review_nb', 'screenshot', 'work_key')
+    link: Optional[str]
+    ean: Optional[str]
+    title: Optional[str]
+    price: Optional[str]
+    currency: Optional[str]
+    description: Optional[str]
+    breadcrumb: Optional[str]
+    review_rate: Optional[str]
+    review_nb: Optional[str]
+    screenshot: Any
+
+    def __init__(self, **values: Any):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        for name, value in values.items():
+            self.add_value(name, value)
+
+    def add_value(self, name: str, value: Any) -> None:
+        """Like ``ItemLoader.add_value``: the first value wins, except for the joined breadcrumb"""
+        if value is None:
+            return
+        if name == 'price' and self.currency is None:
+            # the price loses its symbols, its currency is read from the text as scraped
+            self.add_value('currency', value)
+        input_processor, output_processor = PROCESSORS[name]
+        values = input_processor(value)
+        current = getattr(self, name)
+        if current is not None:
+            if not isinstance(output_processor, Join):
+                return
+            values = [current] + values
+        value = output_processor(values)
+        if name == 'breadcrumb' and value:
+            value = sys.intern(value)
+        setattr(self, name, value)
+
+    def get(self, name: str, default: Any = None) -> Any:
+        value = getattr(self, name, None)
+        return default if value is None else value
@@ -0,0 +1,169 @@
+import logging
+import os
+import pickle
+import sqlite3
+from typing import Iterator, Optional, Set
+
+from scrapy import Request, signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.request import request_from_dict
+
+from ecommerce.screenshots import week_of
+
+
+logger = logging.getLogger(__name__)
+
+# set by the handlers and middlewares while downloading, meaningless in another process
+TRANSIENT_META = (
+    'playwright_page', 'download_slot', 'download_latency', 'download_timeout', 'depth', 'proxy', 'pool_proxy',
+    'cloudflare_clearance', 'retry_times', 'redirect_times', 'redirect_ttl', 'redirect_urls', 'redirect_reasons',
+)
+
+
+def product_key(request: Request) -> str:
+    """The input url a request is about, the spiders keep it in ``meta['url']`` when they call an API"""
+    return request.meta.get('url') or request.url
+
+
+def dump_request(request: Request, spider) -> Optional[bytes]:
+    """The request in the form of Scrapy's disk queues (``to_dict`` pickled), Playwright page methods
+    included, or None if something of it cannot be pickled"""
+    meta = {key: value for key, value in request.meta.items() if key not in TRANSIENT_META}
+    try:
+        return pickle.dumps(request.replace(meta=meta).to_dict(spider=spider), protocol=4)
+    except (ValueError, TypeError, AttributeError, pickle.PicklingError) as e:
+        logger.debug('Request %s not checkpointed: %s', request, e, extra={'spider': spider})
+        return None
+
+
+def load_request(data: bytes, spider) -> Request:
+    return request_from_dict(pickle.loads(data), spider=spider)
+
+
+class JobStore:
+    """Products of a job still in progress, with their latest request, and the products done, in SQLite"""
+
+    def __init__(self, path: str, job: str):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.job = job
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS pending ('
+            'job TEXT, spider TEXT, key TEXT, request BLOB, PRIMARY KEY (job, spider, key))'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS completed ('
+            'job TEXT, spider TEXT, key TEXT, ean TEXT, PRIMARY KEY (job, spider, key))'
+        )
+
+    def pending(self, spider: str) -> Iterator[tuple]:
+        yield from self.db.execute(
+            'SELECT key, request FROM pending WHERE job = ? AND spider = ?', (self.job, spider)
+        ).fetchall()
+
+    def completed(self, spider: str) -> Set[str]:
+        rows = self.db.execute('SELECT key, ean FROM completed WHERE job = ? AND spider = ?', (self.job, spider))
+        return {value for row in rows for value in row if value}
+
+    def checkpoint(self, spider: str, key: str, request: Optional[bytes]) -> None:
+        self.db.execute('INSERT OR REPLACE INTO pending VALUES (?, ?, ?, ?)', (self.job, spider, key, request))
+        self.db.commit()
+
+    def complete(self, spider: str, key: str, ean: Optional[str]) -> None:
+        self.db.execute('DELETE FROM pending WHERE job = ? AND spider = ? AND key = ?', (self.job, spider, key))
+        self.db.execute('INSERT OR REPLACE INTO completed VALUES (?, ?, ?, ?)', (self.job, spider, key, ean))
+        self.db.commit()
+
+    def clear(self, spider: str) -> None:
+        for table in ('pending', 'completed'):
+            self.db.execute(f'DELETE FROM {table} WHERE job = ? AND spider = ?', (self.job, spider))
+        self.db.commit()
+
+    def close(self) -> None:
+        self.db.commit()
+        self.db.close()
+
+
+class ResumableJob:
+    """Spider middleware making a crawl resumable after a crash, enabled by ``JOB_RESUME``.
+
+    Every start request is checkpointed in ``JOB_DB`` under its product (the input url) until an
+    item comes out for that product; a later request of a callback for the same product, like
+    the Playwright request an HTTP-first spider falls back to, replaces it. A rerun of the same
+    job (``JOB_NAME``, the ISO week by default) first sends the checkpointed requests, then reads
+    the inputs again without the products done or already sent. The other requests of a product
+    (APIs, reviews, screenshots) are not kept: they depend on in-memory state, the product starts
+    over and the HTTP cache answers the API calls it made before. A spider that finishes clears
+    its part of the job, so the next run starts from scratch.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('JOB_RESUME'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.store = JobStore(settings.get('JOB_DB'), settings.get('JOB_NAME') or week_of())
+        self.known: Set[str] = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = cls(crawler)
+        crawler.signals.connect(middleware.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def process_start_requests(self, start_requests, spider):
+        self.known = self.store.completed(spider.name)
+        if self.known:
+            logger.info('Resuming job %s: %i products already done', self.store.job, len(self.known),
+                        extra={'spider': spider})
+        for key, data in self.store.pending(spider.name):
+            if data is None:
+                # could not be pickled, its start request is read again from the inputs
+                continue
+            self.known.add(key)
+            self.stats.inc_value('job/restored', spider=spider)
+            yield self._tag(load_request(data, spider), key)
+        for request in start_requests:
+            key = product_key(request)
+            if key in self.known or request.meta.get('sku', request.meta.get('gtin')) in self.known:
+                self.stats.inc_value('job/skipped', spider=spider)
+                continue
+            self.known.add(key)
+            self.store.checkpoint(spider.name, key, dump_request(request, spider))
+            yield self._tag(request, key)
+
+    def process_spider_output(self, response, result, spider):
+        key = response.meta.get('job_key')
+        for output in result:
+            if key is not None and isinstance(output, Request) and 'job_key' not in output.meta \
+                    and product_key(output) == key:
+                self.store.checkpoint(spider.name, key, dump_request(output, spider))
+                self._tag(output, key)
+            yield output
+
+    @staticmethod
+    def _tag(request: Request, key: str) -> Request:
+        request.meta['job_key'] = key
+        return request
+
+    def item_scraped(self, item, response, spider):
+        # the link of the item can be a redirect of the input url the request was checkpointed under
+        keys = {item.get('link'), response.meta.get('job_key') if response is not None else None} - {None}
+        for key in keys:
+            self.store.complete(spider.name, key, item.get('ean'))
+        if keys:
+            self.stats.inc_value('job/completed', spider=spider)
+
+    def spider_closed(self, spider, reason):
+        if reason == 'finished':
+            self.store.clear(spider.name)
+        else:
+            pending = len(list(self.store.pending(spider.name)))
+            logger.info('Job %s closed (%s) with %i products in progress, run it again to resume',
+                        self.store.job, reason, pending, extra={'spider': spider})
+        self.store.close()
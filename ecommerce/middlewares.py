@@ -1,28 +1,73 @@
-import base64
 import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
 
 from cfscrape import get_tokens
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.http import TextResponse
 from twisted.internet import reactor
 from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+from ecommerce.proxies import ProxyPool
 
 
 class ProxyMiddleware(object):
+    """Sends the requests through the ``ProxyPool`` and feeds it back their outcome.
+
+    Requests setting ``proxy`` themselves are left alone, and so are the Playwright requests,
+    the browser does not go through the pool, and the in-memory ``data:`` requests. ``proxy_session``
+    in the request meta, or the ``cookiejar`` for the domains of ``PROXY_STICKY_DOMAINS``, keeps a
+    session on one proxy.
+    """
+
+    def __init__(self, settings):
+        if not settings.getbool('PROXY_ENABLED'):
+            raise NotConfigured
+        self.pool = ProxyPool.from_settings(settings)
+        self.sticky_domains = set(settings.getlist('PROXY_STICKY_DOMAINS'))
+        self.failure_codes = {int(code) for code in settings.getlist('PROXY_FAILURE_CODES', [403, 407, 429, 502, 503, 504])}
+
     @classmethod
     def from_crawler(cls, crawler):
         return cls(crawler.settings)
 
-    def __init__(self, settings):
-        self.user = settings.get('PROXY_USER', 'lum-auth-token')
-        self.password = settings.get('PROXY_PASSWORD', 'BjwW5d4etXa5SbuNzDnWxTFvbAguDzc')
-        self.endpoint = settings.get('PROXY_ENDPOINT', 'devops.data-ox.com')
-        self.port = settings.get('PROXY_PORT', 24261)
+    @staticmethod
+    def routed(request) -> bool:
+        return not request.meta.get('playwright') and not request.url.startswith('data:')
 
     def process_request(self, request, spider):
-        user_credentials = '{user}:{passw}'.format(user=self.user, passw=self.password)
-        basic_authentication = 'Basic ' + base64.b64encode(user_credentials.encode()).decode()
-        host = 'http://{endpoint}:{port}'.format(endpoint=self.endpoint, port=self.port)
-        request.meta['proxy'] = host
-        request.headers['Proxy-Authorization'] = basic_authentication
+        if not self.routed(request) or 'proxy' in request.meta and 'pool_proxy' not in request.meta:
+            return
+        domain = urlparse(request.url).hostname
+        session = request.meta.get('proxy_session')
+        if session is None and domain in self.sticky_domains:
+            session = str(request.meta.get('cookiejar', 0))
+        proxy = self.pool.get(domain, session)
+        request.meta['proxy'] = request.meta['pool_proxy'] = proxy.url
+        if proxy.auth:
+            request.headers['Proxy-Authorization'] = proxy.auth
+        else:
+            request.headers.pop('Proxy-Authorization', None)
+
+    def process_response(self, request, response, spider):
+        proxy = request.meta.get('pool_proxy') if self.routed(request) else None
+        if proxy is not None:
+            if response.status in self.failure_codes:
+                self.pool.failure(proxy)
+            else:
+                self.pool.success(proxy, request.meta.get('download_latency'))
+        return response
+
+    def process_exception(self, request, exception, spider):
+        proxy = request.meta.get('pool_proxy') if self.routed(request) else None
+        if proxy is not None:
+            self.pool.failure(proxy)
 
 
 class DelayedRequestsMiddleware(object):
@@ -36,8 +81,61 @@ class DelayedRequestsMiddleware(object):
         return deferred
 
 
+@dataclass
+class Clearance:
+    cookies: Dict[str, str]
+    user_agent: str
+    expires: float
+
+
+class ClearanceCache:
+    """Cloudflare clearance cookies by domain and proxy, shared by every request until they expire"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.clearances = {}
+
+    def get(self, key: Tuple[str, Optional[str]]) -> Optional[Clearance]:
+        clearance = self.clearances.get(key)
+        if clearance is not None and clearance.expires <= time.time():
+            del self.clearances[key]
+            return None
+        return clearance
+
+    def set(self, key: Tuple[str, Optional[str]], cookies: Dict[str, str], user_agent: str) -> Clearance:
+        clearance = Clearance({name: value for name, value in cookies.items() if value}, user_agent,
+                              time.time() + self.ttl)
+        self.clearances[key] = clearance
+        return clearance
+
+    def invalidate(self, key: Tuple[str, Optional[str]], clearance: Clearance) -> None:
+        if self.clearances.get(key) is clearance:
+            del self.clearances[key]
+
+
 class CloudFlareMiddleware:
-    """Scrapy middleware to bypass the CloudFlare's anti-bot protection"""
+    """Scrapy middleware to bypass the CloudFlare's anti-bot protection.
+
+    Challenges are solved by cfscrape in a thread pool, so the reactor keeps going, and
+    concurrent challenges of a domain wait for the same solve. The clearance cookies are
+    cached per domain and proxy for ``CLOUDFLARE_CLEARANCE_TTL`` seconds and added to the
+    ``Cookie`` header of every request of that domain, so most requests never meet the challenge.
+    """
+
+    def __init__(self, settings):
+        self.user_agent = settings.get('USER_AGENT')
+        self.max_attempts = settings.getint('CLOUDFLARE_MAX_ATTEMPTS', 2)
+        self.cache = ClearanceCache(settings.getfloat('CLOUDFLARE_CLEARANCE_TTL', 1800))
+        self.solving = {}
+        self.threadpool = ThreadPool(minthreads=0, maxthreads=settings.getint('CLOUDFLARE_SOLVER_THREADS', 2),
+                                     name='cloudflare-solver')
+        self.logger = logging.getLogger('cloudflaremiddleware')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = cls(crawler.settings)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
 
     @staticmethod
     def is_cloudflare_challenge(response):
@@ -45,36 +143,96 @@ class CloudFlareMiddleware:
 
         return (
             response.status == 503
-            and response.headers.get('Server', '').startswith(b'cloudflare')
+            and response.headers.get('Server', b'').startswith(b'cloudflare')
             and 'jschl_vc' in response.text
             and 'jschl_answer' in response.text
         )
 
+    @staticmethod
+    def key(request) -> Tuple[str, Optional[str]]:
+        return urlparse(request.url).hostname, request.meta.get('proxy')
+
+    def process_request(self, request, spider):
+        clearance = self.cache.get(self.key(request))
+        if clearance is not None and request.meta.get('cloudflare_clearance') is not clearance:
+            self._apply(request, clearance)
+
     def process_response(self, request, response, spider):
         """Handle the a Scrapy response"""
 
-        if not self.is_cloudflare_challenge(response):
+        if not isinstance(response, TextResponse) or not self.is_cloudflare_challenge(response):
             return response
 
-        logger = logging.getLogger('cloudflaremiddleware')
-
-        logger.debug(
-            'Cloudflare protection detected on %s, trying to bypass...',
-            response.url
-        )
-
-        cloudflare_tokens, __ = get_tokens(
-            request.url,
-            user_agent=spider.settings.get('USER_AGENT')
-        )
-
-        logger.debug(
-            'Successfully bypassed the protection for %s, re-scheduling the request',
-            response.url
-        )
+        attempts = request.meta.get('cloudflare_attempts', 0)
+        if attempts >= self.max_attempts:
+            self.logger.warning('Giving up on the Cloudflare protection of %s after %i attempts',
+                                response.url, attempts)
+            return response
 
-        request.cookies.update(cloudflare_tokens)
-        request.priority = 99999
+        key = self.key(request)
+        used = request.meta.get('cloudflare_clearance')
+        if used is not None:
+            self.cache.invalidate(key, used)
+        # another request may have solved a newer challenge meanwhile
+        current = self.cache.get(key)
+        if current is not None:
+            return self._retry(current, request)
+
+        self.logger.debug('Cloudflare protection detected on %s, trying to bypass...', response.url)
+        deferred = self._solve(key, request.url)
+        deferred.addCallbacks(self._retry, self._failed, callbackArgs=(request,), errbackArgs=(response,))
+        return deferred
 
-        return request
+    def spider_closed(self, spider):
+        if self.threadpool.started:
+            self.threadpool.stop()
+
+    def _solve(self, key: Tuple[str, Optional[str]], url: str) -> Deferred:
+        """Deferred firing with the clearance of ``key``, one solve at a time per key"""
+        waiting = Deferred()
+        if key in self.solving:
+            self.solving[key].append(waiting)
+            return waiting
+        self.solving[key] = [waiting]
+        if not self.threadpool.started:
+            self.threadpool.start()
+        proxy = key[1]
+        kwargs = {'proxies': {'http': proxy, 'https': proxy}} if proxy else {}
+        deferred = deferToThreadPool(reactor, self.threadpool, get_tokens, url, user_agent=self.user_agent, **kwargs)
+        deferred.addBoth(self._solved, key)
+        return waiting
+
+    def _solved(self, result, key: Tuple[str, Optional[str]]) -> None:
+        waiting = self.solving.pop(key)
+        if isinstance(result, Failure):
+            for deferred in waiting:
+                deferred.errback(result)
+            return
+        cookies, user_agent = result
+        clearance = self.cache.set(key, cookies, user_agent)
+        self.logger.debug('Successfully bypassed the protection for %s, %i requests waiting', key[0], len(waiting))
+        for deferred in waiting:
+            deferred.callback(clearance)
+
+    def _retry(self, clearance: Clearance, request):
+        retry = request.replace(dont_filter=True, priority=99999)
+        retry.meta['cloudflare_attempts'] = request.meta.get('cloudflare_attempts', 0) + 1
+        self._apply(retry, clearance)
+        return retry
+
+    def _failed(self, failure, response):
+        self.logger.error('Could not bypass the Cloudflare protection of %s: %s', response.url, failure.value)
+        return response
 
+    @staticmethod
+    def _apply(request, clearance: Clearance) -> None:
+        # COOKIES_ENABLED is off, the clearance goes in the Cookie header itself
+        cookies = {}
+        for pair in request.headers.get('Cookie', b'').decode('latin-1').split(';'):
+            name, _, value = pair.strip().partition('=')
+            if name:
+                cookies[name] = value
+        cookies.update(clearance.cookies)
+        request.headers['Cookie'] = '; '.join(f'{name}={value}' for name, value in cookies.items())
+        request.headers['User-Agent'] = clearance.user_agent
+        request.meta['cloudflare_clearance'] = clearance
@@ -0,0 +1,97 @@
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+
+CURRENCIES = {'€': 'EUR', 'EUR': 'EUR', '$': 'USD', 'USD': 'USD', '£': 'GBP', 'GBP': 'GBP'}
+
+PRICE = re.compile(r'(\d[\d\s \xa0.,]*)')
+CURRENCY = re.compile(r'€|\$|£|\b(?:EUR|USD|GBP)\b')
+THOUSANDS = re.compile(r'[\s \xa0]')
+ISO_CODE = re.compile(r'[A-Z]{3}')
+
+# the typed columns ``typed_columns`` adds to the string ones
+TYPED_FIELDS = ('price_cents', 'ean13', 'rating', 'review_count', 'invalid')
+
+
+def parse_cents(value: Optional[str]) -> Optional[int]:
+    """``'1 299,99 €'``, ``'1.299,99'``, ``'1299.99'`` or ``'15'`` as integer cents, None if it is no price.
+
+    The last separator followed by one or two digits is the decimal one, the others group thousands.
+    """
+    if not value:
+        return None
+    match = PRICE.search(value)
+    if match is None:
+        return None
+    number = THOUSANDS.sub('', match.group(1)).rstrip('.,')
+    head, separator, tail = max(number.rpartition('.'), number.rpartition(','), key=lambda i: len(i[0]))
+    if separator and len(tail) in (1, 2):
+        units, fraction = head.replace('.', '').replace(',', ''), tail.ljust(2, '0')
+    else:
+        units, fraction = number.replace('.', '').replace(',', ''), '00'
+    if not units.isdigit():
+        return None
+    return int(units) * 100 + int(fraction)
+
+
+def format_cents(cents: int) -> str:
+    return f'{cents // 100}.{cents % 100:02d}'
+
+
+def currency_code(value: Optional[str]) -> Optional[str]:
+    """ISO code of the currency of ``'12,99 €'``, ``'$5'`` or ``'eur'``, None if the value names none"""
+    if not value:
+        return None
+    match = CURRENCY.search(value)
+    if match:
+        return CURRENCIES[match.group(0)]
+    code = value.strip().upper()
+    return code if ISO_CODE.fullmatch(code) else None
+
+
+def ean13(value: Optional[str]) -> Optional[str]:
+    """The EAN-13 of a GTIN-8/12/13 (zero padded), or None if it is not one or its check digit is wrong"""
+    if not value or not value.isdigit() or len(value) > 13:
+        return None
+    code = value.zfill(13)
+    total = sum(int(digit) * (3 if position % 2 else 1) for position, digit in enumerate(code[:12]))
+    return code if (10 - total % 10) % 10 == int(code[12]) else None
+
+
+def parse_rating(value: Optional[str]) -> Optional[float]:
+    try:
+        rating = float(value.replace(',', '.')) if value else None
+    except ValueError:
+        return None
+    return rating if rating is not None and 0 <= rating <= 5 else None
+
+
+def parse_count(value: Optional[str]) -> Optional[int]:
+    return int(value) if value and value.isdigit() else None
+
+
+def typed_columns(columns: Dict[str, Sequence[Optional[str]]]) -> Dict[str, List]:
+    """Typed columns of a batch of exported rows, given as string columns by field.
+
+    A value present but not understood is left out of its typed column and the field is named
+    in ``invalid``, so malformed data shows up instead of being passed on as text.
+    """
+    prices, eans = columns['price'], columns['ean']
+    rates, counts = columns['review_rate'], columns['review_nb']
+    cents = [parse_cents(value) for value in prices]
+    typed = {
+        'price_cents': cents,
+        'ean13': [ean13(value) for value in eans],
+        'rating': [parse_rating(value) for value in rates],
+        'review_count': [parse_count(value) for value in counts],
+    }
+    checks: Tuple[Tuple[str, Sequence, List], ...] = (
+        ('price', prices, typed['price_cents']),
+        ('ean', eans, typed['ean13']),
+        ('review_rate', rates, typed['rating']),
+        ('review_nb', counts, typed['review_count']),
+    )
+    typed['invalid'] = [
+        ','.join(name for name, raw, parsed in checks if raw[row] and parsed[row] is None) or None
+        for row in range(len(prices))
+    ]
+    return typed
@@ -2,12 +2,278 @@
 #
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-
+import gzip
+import json
+import os
+import time
+from datetime import date
 
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.defer import deferred_from_coro
+from twisted.internet.defer import DeferredList, DeferredSemaphore
+from twisted.internet.task import LoopingCall
+
+from ecommerce.browser import ChromeDriverPool
+from ecommerce.handlers import release_page
+from ecommerce.items import ProductUnchanged, ScreenshotJob
+from ecommerce.normalize import TYPED_FIELDS, typed_columns
+from ecommerce.screenshots import ScreenshotStore, week_of
+from ecommerce.state import content_hash
+from ecommerce.telemetry import observe
+from ecommerce.workqueue import worker_id
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 
 class EcommercePipeline:
     def process_item(self, item, spider):
         return item
+
+
+class ScreenshotPipeline:
+    """Takes the screenshots the spiders leave as ``ScreenshotJob`` in the ``screenshot`` field.
+
+    The item gets its ``ScreenshotStore`` reference at once and goes on, while the capture,
+    the encoding and the disk write happen in the background. Only ``SCREENSHOT_CONCURRENCY``
+    jobs run at the same time: an item waits here for a free slot, which holds back the
+    scheduler instead of piling up open pages.
+    """
+    FORMATS = ('png', 'jpeg', 'webp')
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.enabled = settings.getbool('SCREENSHOT_ENABLED', True)
+        self.image_format = settings.get('SCREENSHOT_FORMAT', 'png').lower()
+        if self.image_format not in self.FORMATS:
+            raise NotConfigured(f'Unsupported SCREENSHOT_FORMAT: {self.image_format}')
+        if self.image_format != 'png' and Image is None:
+            raise NotConfigured(f'Pillow is required for {self.image_format} screenshots')
+        self.quality = settings.getint('SCREENSHOT_QUALITY', 80)
+        self.full_page = settings.getbool('SCREENSHOT_FULL_PAGE', True)
+        self.slots = DeferredSemaphore(settings.getint('SCREENSHOT_CONCURRENCY', 4))
+        self.pending = set()
+        self.drivers = None
+        self.store = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings)
+
+    def open_spider(self, spider):
+        if self.enabled:
+            self.store = ScreenshotStore.from_settings(self.settings)
+
+    def process_item(self, item, spider):
+        adapter = ItemAdapter(item)
+        job = adapter.get('screenshot')
+        if not isinstance(job, ScreenshotJob):
+            return item
+        if not self.enabled:
+            adapter['screenshot'] = None
+            if job.page is None:
+                return item
+            deferred = deferred_from_coro(release_page(job.page))
+            deferred.addCallback(lambda _: item)
+            return deferred
+        key = adapter.get('ean') or job.name
+        week = week_of()
+        content = content_hash(adapter)
+        adapter['screenshot'] = ScreenshotStore.ref(spider.name, key, week)
+        deferred = self.slots.acquire()
+        deferred.addCallback(lambda _: self._schedule(job, key, week, content, spider))
+        deferred.addCallback(lambda _: item)
+        return deferred
+
+    def close_spider(self, spider):
+        deferred = DeferredList(list(self.pending))
+        if self.drivers is not None:
+            deferred.addCallback(lambda _: self.drivers.close())
+        if self.store is not None:
+            deferred.addCallback(lambda _: self.store.close())
+        return deferred
+
+    def _schedule(self, job: ScreenshotJob, key: str, week: str, content: str, spider) -> None:
+        started = time.perf_counter()
+        deferred = self._capture(job, spider)
+        self.pending.add(deferred)
+        capture = 'screenshot/playwright' if job.page is not None else 'screenshot/selenium'
+        deferred.addCallback(self._timed, spider, capture, started)
+        deferred.addCallback(lambda data: self.store.put(spider.name, key, data, week, content))
+        deferred.addCallback(self._timed, spider, 'screenshot/total', started)
+        deferred.addCallback(
+            lambda stored: spider.crawler.stats.inc_value(
+                'screenshots/stored' if stored.written else 'screenshots/deduplicated', spider=spider
+            )
+        )
+        deferred.addErrback(
+            lambda failure: spider.logger.error('Screenshot failed for %s: %s', job.name, failure.getErrorMessage())
+        )
+        deferred.addBoth(lambda _: self.slots.release())
+        deferred.addBoth(lambda _: self.pending.discard(deferred))
+
+    def _capture(self, job: ScreenshotJob, spider):
+        if job.page is not None:
+            return deferred_from_coro(self._capture_page(job.page))
+        if self.drivers is None:
+            self.drivers = ChromeDriverPool.from_settings(self.settings)
+            self.drivers.observe = lambda stage, seconds: observe(spider, stage, seconds)
+        return self.drivers.screenshot(job.url, self.full_page)
+
+    @staticmethod
+    def _timed(result, spider, stage: str, started: float):
+        observe(spider, stage, time.perf_counter() - started)
+        return result
+
+    async def _capture_page(self, page) -> bytes:
+        try:
+            if self.image_format == 'jpeg':
+                return await page.screenshot(type='jpeg', quality=self.quality, full_page=self.full_page)
+            return await page.screenshot(type='png', full_page=self.full_page)
+        finally:
+            await release_page(page)
+
+
+class IncrementalPipeline:
+    """Records every scraped product in ``spider.product_state`` for the next run"""
+
+    def process_item(self, item, spider):
+        state = getattr(spider, 'product_state', None)
+        adapter = ItemAdapter(item)
+        if state is None or not adapter.get('ean'):
+            return item
+        if isinstance(item, ProductUnchanged):
+            state.touch(spider.name, adapter['ean'])
+        else:
+            state.save(spider.name, adapter['ean'], adapter)
+        return item
+
+
+class ExportPipeline:
+    """Streams the items to one partition per spider and crawl date.
+
+    Items are kept as plain rows and written every ``EXPORT_BATCH_SIZE`` items or
+    ``EXPORT_FLUSH_INTERVAL`` seconds, as Parquet row groups, Arrow IPC record batches
+    and/or gzipped JSON lines, so memory does not grow with the crawl. Each batch gets the
+    typed columns of ``normalize.typed_columns`` next to the scraped strings.
+    """
+    FIELDS = ('link', 'ean', 'title', 'price', 'currency', 'description', 'breadcrumb', 'review_rate', 'review_nb',
+              'screenshot')
+    FORMATS = ('parquet', 'arrow', 'jsonl.gz')
+
+    TYPES = {
+        'price_cents': 'int64', 'ean13': 'string', 'rating': 'float64', 'review_count': 'int64', 'invalid': 'string',
+    }
+
+    def __init__(self, settings, stats=None):
+        self.stats = stats
+        self.spider = None
+        self.export_dir = settings.get('EXPORT_DIR')
+        self.distributed = bool(settings.get('WORK_QUEUE'))
+        self.formats = settings.getlist('EXPORT_FORMATS', ['parquet', 'jsonl.gz'])
+        unknown = set(self.formats) - set(self.FORMATS)
+        if unknown:
+            raise NotConfigured(f'Unsupported EXPORT_FORMATS: {", ".join(unknown)}')
+        if pyarrow is None and {'parquet', 'arrow'} & set(self.formats):
+            raise NotConfigured('pyarrow is required for parquet and arrow exports')
+        self.batch_size = settings.getint('EXPORT_BATCH_SIZE', 5000)
+        self.flush_interval = settings.getfloat('EXPORT_FLUSH_INTERVAL', 60)
+        if pyarrow is not None:
+            self.schema = pyarrow.schema(
+                [pyarrow.field(name, pyarrow.string()) for name in self.FIELDS]
+                + [pyarrow.field('changed', pyarrow.bool_())]
+                + [pyarrow.field(name, getattr(pyarrow, self.TYPES[name])()) for name in TYPED_FIELDS]
+            )
+        self.rows = []
+        self.writers = {}
+        self.partition = None
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings, crawler.stats)
+
+    def open_spider(self, spider):
+        self.spider = spider
+        self.partition = os.path.join(self.export_dir, f'spider={spider.name}', f'date={date.today().isoformat()}')
+        os.makedirs(self.partition, exist_ok=True)
+        self.part = f'part-{int(time.time())}'
+        if self.distributed:
+            # the workers of a queue export to the same partitions
+            self.part += f'-{worker_id()}'
+        self.task = LoopingCall(self.flush)
+        self.task.start(self.flush_interval, now=False)
+
+    def process_item(self, item, spider):
+        adapter = ItemAdapter(item)
+        row = {name: adapter.get(name) for name in self.FIELDS}
+        changed = not isinstance(item, ProductUnchanged)
+        state = getattr(spider, 'product_state', None)
+        if not changed and state is not None:
+            stored = state.get(spider.name, row['ean']) or {}
+            row.update(title=stored.get('title'), price=stored.get('price'), currency=stored.get('currency'),
+                       review_nb=stored.get('review_nb'))
+        self.rows.append(tuple(row[name] for name in self.FIELDS) + (changed,))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+        return item
+
+    def close_spider(self, spider):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.flush()
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+
+    def flush(self) -> None:
+        if not self.rows:
+            return
+        rows, self.rows = self.rows, []
+        columns = list(zip(*rows))
+        typed = typed_columns(dict(zip(self.FIELDS, columns)))
+        self._count_invalid(typed['invalid'])
+        columns += [typed[name] for name in TYPED_FIELDS]
+        table = None
+        for export_format in self.formats:
+            writer = self._writer(export_format)
+            if export_format == 'jsonl.gz':
+                names = self.FIELDS + ('changed',) + TYPED_FIELDS
+                writer.writelines(json.dumps(dict(zip(names, row)), ensure_ascii=False) + '\n' for row in zip(*columns))
+                continue
+            if table is None:
+                table = pyarrow.Table.from_arrays(
+                    [pyarrow.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+                    schema=self.schema
+                )
+            writer.write_table(table)
+
+    def _count_invalid(self, invalid) -> None:
+        if self.stats is None:
+            return
+        for names in invalid:
+            for name in names.split(',') if names else ():
+                self.stats.inc_value(f'export/invalid/{name}', spider=self.spider)
+
+    def _writer(self, export_format: str):
+        if export_format not in self.writers:
+            path = os.path.join(self.partition, f'{self.part}.{export_format}')
+            if export_format == 'parquet':
+                writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='zstd')
+            elif export_format == 'arrow':
+                writer = pyarrow.ipc.new_file(path, self.schema)
+            else:
+                writer = gzip.open(path, 'wt', encoding='utf-8')
+            self.writers[export_format] = writer
+        return self.writers[export_format]
@@ -0,0 +1,120 @@
+import base64
+import random
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import quote, unquote, urlparse, urlunparse
+
+from ecommerce.inputs import iter_records
+
+
+class Proxy:
+    """One proxy endpoint, its precomputed ``Proxy-Authorization`` header and its health"""
+
+    def __init__(self, url: str):
+        parsed = urlparse(url if '://' in url else f'http://{url}')
+        self.url = urlunparse((parsed.scheme, f'{parsed.hostname}:{parsed.port}' if parsed.port else parsed.hostname,
+                               '', '', '', ''))
+        self.auth = None
+        if parsed.username:
+            credentials = f'{unquote(parsed.username)}:{unquote(parsed.password or "")}'
+            self.auth = b'Basic ' + base64.b64encode(credentials.encode())
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.banned_until = 0.0
+        self.requests = 0
+
+    def __repr__(self):
+        return f'<Proxy {self.url} score={self.score:.2f} failures={self.failures}>'
+
+    @property
+    def score(self) -> float:
+        """Higher is better: the share of successes per second of latency"""
+        return (1 - self.error_rate) / (self.latency or 1.0)
+
+    def available(self, now: float) -> bool:
+        return self.banned_until <= now
+
+    def success(self, latency: Optional[float]) -> None:
+        self.requests += 1
+        self.failures = 0
+        self.error_rate *= 0.9
+        if latency is not None:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+
+    def failure(self, max_failures: int, ban_time: float) -> None:
+        self.requests += 1
+        self.failures += 1
+        self.error_rate = 0.9 * self.error_rate + 0.1
+        if self.failures >= max_failures:
+            self.banned_until = time.time() + ban_time
+
+
+class ProxyPool:
+    """Picks a proxy per request, weighted by health score.
+
+    Requests of a session (a domain and a session key, e.g. the cookiejar) keep the same proxy
+    while it stays available, so cookies and Cloudflare clearances stay valid and Scrapy's
+    persistent connection pool keeps reusing the connections to that proxy.
+    """
+
+    def __init__(self, proxies: Iterable[Proxy], max_failures: int = 3, ban_time: float = 300):
+        self.proxies = list(proxies)
+        self.by_url = {proxy.url: proxy for proxy in self.proxies}
+        self.max_failures = max_failures
+        self.ban_time = ban_time
+        self.sessions: Dict[Tuple[str, str], Proxy] = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            load_proxies(settings),
+            max_failures=settings.getint('PROXY_MAX_FAILURES', 3),
+            ban_time=settings.getfloat('PROXY_BAN_TIME', 300),
+        )
+
+    def __len__(self):
+        return len(self.proxies)
+
+    def get(self, domain: str, session: Optional[str] = None) -> Proxy:
+        now = time.time()
+        if session is not None:
+            proxy = self.sessions.get((domain, session))
+            if proxy is not None and proxy.available(now):
+                return proxy
+        proxy = self.choose(now)
+        if session is not None:
+            self.sessions[(domain, session)] = proxy
+        return proxy
+
+    def choose(self, now: float) -> Proxy:
+        available = [proxy for proxy in self.proxies if proxy.available(now)]
+        if not available:
+            return min(self.proxies, key=lambda proxy: proxy.banned_until)
+        return random.choices(available, weights=[proxy.score for proxy in available])[0]
+
+    def success(self, url: str, latency: Optional[float]) -> None:
+        proxy = self.by_url.get(url)
+        if proxy is not None:
+            proxy.success(latency)
+
+    def failure(self, url: str) -> None:
+        proxy = self.by_url.get(url)
+        if proxy is not None:
+            proxy.failure(self.max_failures, self.ban_time)
+
+
+def load_proxies(settings) -> List[Proxy]:
+    """Proxies of ``PROXY_LIST`` and of the ``PROXY_LIST_FILE`` (one url per line, or a CSV with an url
+    column), else the single ``PROXY_ENDPOINT``"""
+    urls = list(settings.getlist('PROXY_LIST'))
+    path = settings.get('PROXY_LIST_FILE')
+    if path:
+        urls.extend(record['url'] for record in iter_records(path) if record.get('url'))
+    if not urls:
+        user = settings.get('PROXY_USER', 'lum-auth-token')
+        password = settings.get('PROXY_PASSWORD', 'BjwW5d4etXa5SbuNzDnWxTFvbAguDzc')
+        endpoint = settings.get('PROXY_ENDPOINT', 'devops.data-ox.com')
+        port = settings.get('PROXY_PORT', 24261)
+        urls.append(f'http://{quote(user, safe="")}:{quote(password, safe="")}@{endpoint}:{port}')
+    return [Proxy(url) for url in dict.fromkeys(urls)]
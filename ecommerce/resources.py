@@ -0,0 +1,82 @@
+import re
+from collections import Counter
+from typing import Dict, Iterable, Optional
+from urllib.parse import urlparse
+
+
+# analytics, tag managers and ads the retailer pages load, never needed for the data nor the screenshot
+TRACKER_PATTERNS = [
+    r'google-analytics\.com', r'googletagmanager\.com', r'googleadservices\.com', r'doubleclick\.net',
+    r'facebook\.(net|com)', r'hotjar\.com', r'criteo\.(com|net)', r'abtasty\.com', r'contentsquare\.net',
+    r'tiktok\.com', r'bat\.bing\.com', r'pinterest\.com', r'snapchat\.com', r'kameleoon\.(eu|com)',
+]
+
+DEFAULT_PROFILES = {
+    # only the DOM text is read from the page
+    'extract': {
+        'resource_types': ['image', 'media', 'font', 'stylesheet', 'texttrack', 'eventsource', 'websocket',
+                           'manifest', 'other'],
+        'block_patterns': TRACKER_PATTERNS,
+        'allow_patterns': [],
+        'block_third_party': True,
+    },
+    # the page is also captured, so it has to look like the real one
+    'screenshot': {
+        'resource_types': ['media', 'texttrack', 'eventsource', 'websocket', 'manifest'],
+        'block_patterns': TRACKER_PATTERNS,
+        'allow_patterns': [],
+        'block_third_party': False,
+    },
+}
+
+
+def site_of(url: str) -> Optional[str]:
+    host = urlparse(url).hostname
+    return '.'.join(host.split('.')[-2:]) if host else None
+
+
+class ResourceProfile:
+    """Which sub-resources of a page are aborted before they are downloaded"""
+
+    def __init__(self, name: str, resource_types: Iterable[str] = (), block_patterns: Iterable[str] = (),
+                 allow_patterns: Iterable[str] = (), block_third_party: bool = False):
+        self.name = name
+        self.resource_types = set(resource_types)
+        self.block = [re.compile(pattern) for pattern in block_patterns]
+        self.allow = [re.compile(pattern) for pattern in allow_patterns]
+        self.block_third_party = block_third_party
+
+    def blocks(self, request, site: Optional[str]) -> bool:
+        if request.is_navigation_request():
+            return False
+        url = request.url
+        if any(pattern.search(url) for pattern in self.allow):
+            return False
+        if request.resource_type in self.resource_types:
+            return True
+        if any(pattern.search(url) for pattern in self.block):
+            return True
+        return self.block_third_party and site is not None and site_of(url) != site
+
+
+def load_profiles(settings) -> Dict[str, ResourceProfile]:
+    """``DEFAULT_PROFILES`` updated with the ``PLAYWRIGHT_RESOURCE_PROFILES`` setting"""
+    profiles = dict(DEFAULT_PROFILES)
+    profiles.update(settings.getdict('PLAYWRIGHT_RESOURCE_PROFILES'))
+    return {name: ResourceProfile(name, **options) for name, options in profiles.items() if options is not None}
+
+
+class PageResources:
+    """Requests a page let through or blocked, reported when the page closes or serves another request"""
+
+    def __init__(self, profile: Optional[ResourceProfile], site: Optional[str]):
+        self.profile = profile
+        self.site = site
+        self.requests = 0
+        self.bytes_loaded = 0
+        self.blocked = Counter()
+
+    def on_response(self, response) -> None:
+        length = response.headers.get('content-length')
+        if length and length.isdigit():
+            self.bytes_loaded += int(length)
@@ -0,0 +1,176 @@
+import hashlib
+import math
+import os
+import sqlite3
+import time
+from datetime import date
+from io import BytesIO
+from typing import NamedTuple, Optional, Tuple
+
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+EXTENSIONS = {'png': 'png', 'jpeg': 'jpg', 'webp': 'webp'}
+
+
+def week_of(day: Optional[date] = None) -> str:
+    """ISO week, as in the price index"""
+    return (day or date.today()).strftime('%G-W%V')
+
+
+def tile_hash(image, tile: int = 128) -> bytes:
+    """Difference hash of every ``tile`` x ``tile`` square of the image, 8 bytes per tile.
+
+    A whole-page hash would not see a price changing on a full page capture, hashing
+    each tile keeps small changes visible. Gradients under 8 grey levels are ignored so
+    compression and rendering noise on flat areas flip no bit.
+    """
+    columns, rows = math.ceil(image.width / tile), math.ceil(image.height / tile)
+    small = image.convert('L').resize((columns * 9, rows * 8))
+    pixels = small.load()
+    digest = bytearray()
+    for row in range(rows):
+        for column in range(columns):
+            bits = 0
+            for y in range(row * 8, row * 8 + 8):
+                for x in range(column * 9, column * 9 + 8):
+                    bits = bits << 1 | (pixels[x, y] > pixels[x + 1, y] + 8)
+            digest += bits.to_bytes(8, 'big')
+    return bytes(digest)
+
+
+def similar(first: bytes, second: bytes, threshold: int) -> bool:
+    """True if no tile differs by more than ``threshold`` bits, the pages must have the same size"""
+    if len(first) != len(second):
+        return False
+    for start in range(0, len(first), 8):
+        a = int.from_bytes(first[start:start + 8], 'big')
+        b = int.from_bytes(second[start:start + 8], 'big')
+        if bin(a ^ b).count('1') > threshold:
+            return False
+    return True
+
+
+class Stored(NamedTuple):
+    blob: str
+    phash: Optional[bytes]
+    written: bool
+
+
+class ScreenshotStore:
+    """Screenshots kept once under the SHA-256 of their content in ``blobs/``.
+
+    ``index.db`` maps (spider, EAN, ISO week) to a blob. A capture looking like the latest one
+    of the product (see ``tile_hash``), taken for the same scraped content, points to the same
+    blob instead of adding a file: a page whose data changed always gets its own capture.
+    Hashing, encoding and writing run in a pool of ``workers`` threads; the index is only
+    touched from the reactor thread.
+    """
+
+    def __init__(self, root: str, image_format: str = 'png', quality: int = 80, tile: int = 32,
+                 threshold: int = 2, workers: int = 2):
+        self.root = root
+        self.blobs = os.path.join(root, 'blobs')
+        os.makedirs(self.blobs, exist_ok=True)
+        self.image_format = image_format
+        self.quality = quality
+        self.tile = tile
+        self.threshold = threshold
+        self.db = sqlite3.connect(os.path.join(root, 'index.db'))
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS screenshots ('
+            'spider TEXT, ean TEXT, week TEXT, blob TEXT, phash BLOB, content TEXT, taken_at REAL, '
+            'PRIMARY KEY (spider, ean, week))'
+        )
+        self.threadpool = ThreadPool(minthreads=1, maxthreads=workers, name='screenshot-store')
+        self.threadpool.start()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            settings.get('SCREEN_DIR'),
+            image_format=settings.get('SCREENSHOT_FORMAT', 'png').lower(),
+            quality=settings.getint('SCREENSHOT_QUALITY', 80),
+            tile=settings.getint('SCREENSHOT_TILE', 32),
+            threshold=settings.getint('SCREENSHOT_TILE_THRESHOLD', 2),
+            workers=settings.getint('SCREENSHOT_STORE_WORKERS', 2),
+        )
+
+    @staticmethod
+    def ref(spider: str, ean: str, week: str) -> str:
+        """What the items hold in their ``screenshot`` field"""
+        return f'{spider}/{ean}/{week}'
+
+    def put(self, spider: str, ean: str, data: bytes, week: Optional[str] = None, content: Optional[str] = None):
+        """Store a capture of a page showing ``content`` (a hash of its data), the Deferred fires with a ``Stored``"""
+        from twisted.internet import reactor
+        week = week or week_of()
+        previous = self.latest(spider, ean)
+        if previous is not None and (content is None or previous[2] != content):
+            previous = None
+        deferred = deferToThreadPool(reactor, self.threadpool, self._prepare, data, previous)
+        deferred.addCallback(self._index, spider, ean, week, content)
+        return deferred
+
+    def latest(self, spider: str, ean: str) -> Optional[Tuple[str, bytes, str]]:
+        return self.db.execute(
+            'SELECT blob, phash, content FROM screenshots WHERE spider = ? AND ean = ? ORDER BY week DESC LIMIT 1',
+            (spider, ean),
+        ).fetchone()
+
+    def resolve(self, ref: str) -> Optional[str]:
+        """Path of the blob behind an item ``screenshot`` value"""
+        spider, ean, week = ref.rsplit('/', 2)
+        row = self.db.execute(
+            'SELECT blob FROM screenshots WHERE spider = ? AND ean = ? AND week = ?', (spider, ean, week)
+        ).fetchone()
+        return os.path.join(self.blobs, row[0]) if row else None
+
+    def close(self) -> None:
+        self.threadpool.stop()
+        self.db.commit()
+        self.db.close()
+
+    def _prepare(self, data: bytes, previous: Optional[Tuple[str, bytes, str]]) -> Stored:
+        image = Image.open(BytesIO(data)) if Image is not None else None
+        phash = tile_hash(image, self.tile) if image is not None else None
+        if previous is not None and phash is not None and previous[1] is not None \
+                and similar(phash, previous[1], self.threshold):
+            return Stored(previous[0], phash, False)
+        data = self._encode(image, data)
+        digest = hashlib.sha256(data).hexdigest()
+        blob = os.path.join(digest[:2], f'{digest}.{EXTENSIONS[self.image_format]}')
+        path = os.path.join(self.blobs, blob)
+        if os.path.exists(path):
+            return Stored(blob, phash, False)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f'{path}.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(f'{path}.tmp', path)
+        return Stored(blob, phash, True)
+
+    def _encode(self, image, data: bytes) -> bytes:
+        if image is None or ((image.format or '').lower() == self.image_format and self.image_format != 'png'):
+            return data
+        buffer = BytesIO()
+        if self.image_format == 'png':
+            image.save(buffer, format='PNG', optimize=True)
+        else:
+            image = image.convert('RGB') if self.image_format == 'jpeg' else image
+            image.save(buffer, format=self.image_format.upper(), quality=self.quality)
+        return buffer.getvalue()
+
+    def _index(self, stored: Stored, spider: str, ean: str, week: str, content: Optional[str]) -> Stored:
+        self.db.execute(
+            'INSERT OR REPLACE INTO screenshots VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (spider, ean, week, stored.blob, stored.phash, content, time.time()),
+        )
+        self.db.commit()
+        return stored
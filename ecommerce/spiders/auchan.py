@@ -1,13 +1,26 @@
-import os
 from datetime import datetime
+from typing import Optional
 
 import scrapy
-from scrapy import Selector
-from scrapy.loader import ItemLoader
-from scrapy_playwright.page import PageCoroutine
 
-from ecommerce.items import Product, remove_n
-from ecommerce.settings import SCREEN_DIR
+from ecommerce.assembly import Assembly, ItemAssembler
+from ecommerce.extraction import FieldSpec, Match, ProductSpec, own_text
+from ecommerce.handlers import release_page
+from ecommerce.inputs import start_records
+from ecommerce.items import ProductRecord, ScreenshotJob
+from ecommerce.state import unchanged_marker
+from ecommerce.telemetry import timed
+from ecommerce.structured import product_fields
+
+
+def feature_ean(wrapper) -> Optional[str]:
+    """EAN of a product description feature block, if the block is the one labelled EAN"""
+    if not any('EAN' in text for span in wrapper.iter('span') for text in own_text(span)):
+        return None
+    for values in wrapper.iter('div'):
+        if values.get('class') == 'product-description__feature-values':
+            return ''.join(own_text(values)).split('/')[-1]
+    return None
 
 
 class AuchanComSpider(scrapy.Spider):
@@ -15,10 +28,9 @@ class AuchanComSpider(scrapy.Spider):
     allowed_domains = ['www.auchan.fr']
     custom_settings = {
         "DOWNLOAD_HANDLERS": {
-            "http": "scrapy_playwright.handler.ScrapyPlaywrightDownloadHandler",
-            "https": "scrapy_playwright.handler.ScrapyPlaywrightDownloadHandler",
-        },
-        "TWISTED_REACTOR": "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
+            "http": "ecommerce.handlers.SharedBrowserDownloadHandler",
+            "https": "ecommerce.handlers.SharedBrowserDownloadHandler",
+        }
     }
     start_urls = [
         'https://www.auchan.fr/sony-shadow-of-the-colossus-ps4/pr-C1028174',
@@ -34,56 +46,112 @@ class AuchanComSpider(scrapy.Spider):
         # 'https://www.auchan.fr/puzzle-150-p-evoli-et-ses-evolution/pr-8bc487a5-34b6-4047-9e97-3a0a2d706bc9'
     ]
     REVIEWS_URL = 'https://www.auchan.fr/reviews?productId={}&sort=SubmissionTime:desc'
+    HTTP_REQUIRED_FIELDS = ('title', 'price', 'ean', 'breadcrumb')
+    PRODUCT_SPEC = ProductSpec(
+        FieldSpec('title', Match('h1')),
+        FieldSpec('price', Match('div', contains={'class': 'product-price product-price--large'})),
+        FieldSpec('description', Match('div', parent=Match('div', parent=Match(
+            'div', contains={'class': 'product-description'})))),
+        FieldSpec('breadcrumb', Match('span', equals={'class': 'site-breadcrumb__item'}, parent=Match('nav')),
+                  many=True),
+        FieldSpec('review_rate', Match('span', parent=Match('span', equals={'class': 'rating-value'}))),
+        FieldSpec('review_nb', Match('span', contains={'itemprop': 'reviewCount'})),
+        FieldSpec('ean', Match('div', equals={'class': 'product-description__feature-wrapper'}),
+                  extract=feature_ean),
+    )
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.assembler = ItemAssembler.from_crawler(crawler, spider.assembled)
+        return spider
 
     def start_requests(self):
-        for url in self.start_urls:
-            yield scrapy.Request(
-                url, self.parse,
-                meta={
-                    'playwright': True,
-                    "playwright_include_page": True,
-                    "playwright_page_coroutines": {
-                        "clickallbtns": PageCoroutine(
-                            "evaluate",
-                            "document.querySelector('#onetrust-accept-btn-handler').click()"
-                        ),
-                    }
-                },
-                errback=self.errback
+        for record in start_records(self):
+            url = record['url']
+            if self.settings.getbool('HTTP_FIRST', True):
+                yield scrapy.Request(url, self.parse_http)
+            else:
+                yield self.playwright_request(url)
+
+    def playwright_request(self, url: str) -> scrapy.Request:
+        return scrapy.Request(
+            url, self.parse,
+            meta={
+                'playwright': True,
+                "playwright_include_page": True,
+                # clicked once per context, the pages after it have the consent cookies
+                'playwright_consent': '#onetrust-accept-btn-handler'
+            },
+            errback=self.errback,
+            dont_filter=True
+        )
+
+    def parse_http(self, response, **kwargs):
+        fields = product_fields(response)
+        missing = [name for name in self.HTTP_REQUIRED_FIELDS if name not in fields]
+        if missing:
+            self.logger.debug('No %s in structured data of %s, rendering the page', ', '.join(missing), response.url)
+            yield self.playwright_request(response.url)
+            return
+        item = ProductRecord(link=response.url, **fields)
+        marker = unchanged_marker(self, fields['ean'], response.url, item)
+        if marker is not None:
+            yield marker
+            return
+        if 'review_rate' not in fields and self.settings.getbool('AUCHAN_REVIEWS'):
+            # the rating is not always in the structured data, the reviews endpoint has it
+            item.work_key = response.meta.get('work_key')
+            self.assembler.start(fields['ean'], item, ('reviews',), url=response.url)
+            yield self.assembler.request(
+                fields['ean'], 'reviews', self.REVIEWS_URL.format(response.url.rsplit('/pr-', 1)[-1]),
+                self.parse_reviews, errback=self.part_errback
             )
+            return
+        screenshot_name = f'{self.name}_{fields["ean"]}_{int(datetime.now().timestamp())}'
+        item.screenshot = ScreenshotJob(name=screenshot_name, url=response.url)
+        yield item
 
     async def parse(self, response, **kwargs):
         page = response.meta["playwright_page"]
-        html = await page.content()
-        sel = Selector(text=html)
-        loader = ItemLoader(item=Product(), selector=sel)
-        loader.add_xpath('title', '//h1')
-        loader.add_xpath('price', '//div[contains(@class, "product-price product-price--large")]')
-        loader.add_xpath('description', '//div[contains(@class, "product-description")]/div/div')
-        loader.add_xpath('breadcrumb', '//nav/span[@class="site-breadcrumb__item"]')
-        loader.add_xpath('review_rate', '//span[@class="rating-value"]/span')
-        loader.add_xpath('review_nb', '//span[contains(@itemprop, "reviewCount")]')
-        loader.add_value('link', response.url)
-        sku = self.get_sku(sel)
-        loader.add_xpath('ean', sku)
-        screenshot_path = os.path.join(SCREEN_DIR, f'{self.name}_{remove_n(sku)}_{int(datetime.now().timestamp())}.png')
-        await page.screenshot(path=screenshot_path, full_page=True)
-        loader.add_value('screenshot', screenshot_path)
-        await page.close()
-        yield loader.load_item()
-
-    def get_sku(self, selector) -> str:
-        for el in selector.xpath('//div[@class="product-description__feature-wrapper"]'):
-            for span in el.xpath('//span/text()').getall():
-                if 'EAN' in span:
-                    print('found ean')
-                    return (
-                        el.xpath('//div[@class="product-description__feature-wrapper"]'
-                                 '//div[@class="product-description__feature-values"]/text()').get()
-                    ).split('/')[-1]
+        try:
+            with timed(self, 'page_content'):
+                html = await page.content()
+            item = ProductRecord(link=response.url)
+            with timed(self, 'extract'):
+                self.PRODUCT_SPEC.populate(item, html)
+            marker = unchanged_marker(self, item.get('ean'), response.url, item)
+        except Exception:
+            # an unreleased page would hold its slot of PLAYWRIGHT_MAX_PAGES for good
+            await release_page(page)
+            raise
+        if marker is not None:
+            await release_page(page)
+            yield marker
+            return
+        screenshot_name = f'{self.name}_{item.get("ean")}_{int(datetime.now().timestamp())}'
+        item.screenshot = ScreenshotJob(name=screenshot_name, page=page)
+        yield item
+
+    def parse_reviews(self, response):
+        fields = product_fields(response)
+        yield from self.assembler.deliver(response.meta['assembly'], response.meta['part'], {
+            'review_rate': fields.get('review_rate'), 'review_nb': fields.get('review_nb'),
+        })
+
+    def part_errback(self, failure):
+        meta = failure.request.meta
+        yield from self.assembler.fail(meta['assembly'], meta['part'])
+
+    def assembled(self, assembly: Assembly):
+        screenshot_name = f'{self.name}_{assembly.key}_{int(datetime.now().timestamp())}'
+        assembly.item.screenshot = ScreenshotJob(name=screenshot_name, url=assembly.context['url'])
+        return assembly.item
 
     async def errback(self, failure):
-        page = failure.request.meta["playwright_page"]
-        await page.close()
+        # a failed download closed its page already, an HTTP error still has it
+        page = failure.request.meta.get("playwright_page")
+        if page is not None:
+            await release_page(page)
 
 
@@ -1,14 +1,15 @@
-import os
 from datetime import datetime
 from urllib.parse import urlparse
 
 import scrapy
-from scrapy import Selector
-from scrapy.loader import ItemLoader
-from scrapy_playwright.page import PageCoroutine
 
-from ecommerce.items import Product
-from ecommerce.settings import SCREEN_DIR
+from ecommerce.extraction import FieldSpec, Match, ProductSpec
+from ecommerce.handlers import release_page
+from ecommerce.inputs import start_records
+from ecommerce.items import ProductRecord, ScreenshotJob
+from ecommerce.state import not_modified, unchanged_marker
+from ecommerce.telemetry import timed
+from ecommerce.structured import product_fields
 
 
 class СarreFourSpider(scrapy.Spider):
@@ -19,50 +20,87 @@ class СarreFourSpider(scrapy.Spider):
     ]
     custom_settings = {
         "DOWNLOAD_HANDLERS": {
-            "http": "scrapy_playwright.handler.ScrapyPlaywrightDownloadHandler",
-            "https": "scrapy_playwright.handler.ScrapyPlaywrightDownloadHandler",
-        },
-        "TWISTED_REACTOR": "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
+            "http": "ecommerce.handlers.SharedBrowserDownloadHandler",
+            "https": "ecommerce.handlers.SharedBrowserDownloadHandler",
+        }
     }
+    HTTP_REQUIRED_FIELDS = ('title', 'price', 'breadcrumb')
+    PRODUCT_SPEC = ProductSpec(
+        FieldSpec('title', Match('h1')),
+        FieldSpec('description', Match('p', parent=Match('div', equals={'class': 'secondary-details__description'}))),
+        FieldSpec('price', Match('div', equals={'class': 'product-card-price__price'})),
+        FieldSpec('breadcrumb', Match('li', parent=Match(equals={'class': 'breadcrumb-trail__list'})), many=True),
+    )
 
     def start_requests(self):
-        for url in self.start_urls:
-            gtin = urlparse(url).path.split('/')[-1].split('-')[-1]
-            yield scrapy.Request(
-                url, self.parse,
-                meta={
-                    'playwright': True,
-                    "playwright_include_page": True,
-                    "playwright_page_coroutines": {
-                        "clickallbtns": PageCoroutine(
-                            "evaluate",
-                            "document.querySelector('#onetrust-accept-btn-handler').click()"
-                        ),
-                    },
-                    'gtin': gtin
-                },
-                errback=self.errback
-            )
+        for record in start_records(self):
+            url = record['url']
+            gtin = record.get('ean') or urlparse(url).path.split('/')[-1].split('-')[-1]
+            if self.settings.getbool('HTTP_FIRST', True):
+                yield scrapy.Request(url, self.parse_http, meta={'gtin': gtin, 'conditional': True})
+            else:
+                yield self.playwright_request(url, gtin)
+
+    def playwright_request(self, url: str, gtin: str) -> scrapy.Request:
+        return scrapy.Request(
+            url, self.parse,
+            meta={
+                'playwright': True,
+                "playwright_include_page": True,
+                # clicked once per context, the pages after it have the consent cookies
+                'playwright_consent': '#onetrust-accept-btn-handler',
+                'gtin': gtin
+            },
+            errback=self.errback,
+            dont_filter=True
+        )
+
+    def parse_http(self, response, **kwargs):
+        gtin = response.meta['gtin']
+        if response.status == 304:
+            yield not_modified(self, response, gtin, response.url)
+            return
+        fields = product_fields(response)
+        missing = [name for name in self.HTTP_REQUIRED_FIELDS if name not in fields]
+        if missing:
+            self.logger.debug('No %s in structured data of %s, rendering the page', ', '.join(missing), response.url)
+            yield self.playwright_request(response.url, gtin)
+            return
+        fields.setdefault('ean', gtin)
+        item = ProductRecord(link=response.url, **fields)
+        marker = unchanged_marker(self, gtin, response.url, item)
+        if marker is not None:
+            yield marker
+            return
+        screenshot_name = f'{self.name}_{gtin}_{int(datetime.now().timestamp())}'
+        item.screenshot = ScreenshotJob(name=screenshot_name, url=response.url)
+        yield item
 
     async def parse(self, response, **kwargs):
         page = response.meta["playwright_page"]
         gtin = response.meta['gtin']
-        html = await page.content()
-        sel = Selector(text=html)
-        loader = ItemLoader(item=Product(), selector=sel)
-        loader.add_value('link', response.url)
-        loader.add_value('ean', gtin)
-        loader.add_xpath('title', '//h1')
-        loader.add_xpath('description', '//div[@class="secondary-details__description"]/p')
-        loader.add_xpath('price', '//div[@class="product-card-price__price"]')
-        loader.add_xpath('breadcrumb', '//*[@class="breadcrumb-trail__list"]/li')
-        screenshot_path = os.path.join(SCREEN_DIR, f'{self.name}_{gtin}_{int(datetime.now().timestamp())}.png')
-        await page.screenshot(path=screenshot_path, full_page=True)
-        loader.add_value('screenshot', screenshot_path)
+        try:
+            with timed(self, 'page_content'):
+                html = await page.content()
+            item = ProductRecord(link=response.url, ean=gtin)
+            with timed(self, 'extract'):
+                self.PRODUCT_SPEC.populate(item, html)
+            marker = unchanged_marker(self, gtin, response.url, item)
+        except Exception:
+            # an unreleased page would hold its slot of PLAYWRIGHT_MAX_PAGES for good
+            await release_page(page)
+            raise
+        if marker is not None:
+            await release_page(page)
+            yield marker
+            return
+        screenshot_name = f'{self.name}_{gtin}_{int(datetime.now().timestamp())}'
+        item.screenshot = ScreenshotJob(name=screenshot_name, page=page)
         # TODO: reviews not found
-        await page.close()
-        yield loader.load_item()
+        yield item
 
     async def errback(self, failure):
-        page = failure.request.meta["playwright_page"]
-        await page.close()
+        # a failed download closed its page already, an HTTP error still has it
+        page = failure.request.meta.get("playwright_page")
+        if page is not None:
+            await release_page(page)
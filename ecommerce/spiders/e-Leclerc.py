@@ -1,16 +1,16 @@
-import os
-import time
 from datetime import datetime
 from typing import List, Dict, Any, Union
 from urllib.parse import urlparse
 
 import scrapy
-from scrapy.loader import ItemLoader
-from selenium import webdriver
-from selenium.webdriver.common.by import By
 
-from ecommerce.items import Product
-from ecommerce.settings import SCREEN_DIR, CHROME_DRIVER_PATH
+from ecommerce.assembly import Assembly, ItemAssembler
+from ecommerce.batching import RequestBatcher
+from ecommerce.inputs import start_records
+from ecommerce.items import ProductRecord, ScreenshotJob
+from ecommerce.normalize import format_cents
+from ecommerce.state import not_modified, unchanged_marker
+from ecommerce.telemetry import observe
 
 
 class ELeclercSpider(scrapy.Spider):
@@ -38,28 +38,57 @@ class ELeclercSpider(scrapy.Spider):
                              '&sortKey=TotalPositiveFeedbackCount&sortOrder=Desc'
     CATEGORIES_DETAIL = 'https://www.e.leclerc/api/rest/live-api/category-details-by-codes?codes={}'
 
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.category_batcher = RequestBatcher(
+            crawler,
+            spider.categories_request,
+            size=crawler.settings.getint('ELECLERC_CATEGORY_BATCH_SIZE', 20),
+            window=crawler.settings.getfloat('ELECLERC_CATEGORY_BATCH_WINDOW', 0.5),
+        )
+        # the breadcrumb and the reviews of a product are fetched concurrently once its sku is known
+        spider.assembler = ItemAssembler.from_crawler(crawler, spider.assembled)
+        # breadcrumbs by category code for the whole run, and the skus of the products waiting for one
+        spider.breadcrumbs = {}
+        spider.waiting_breadcrumb = {}
+        return spider
+
     def start_requests(self):
-        for url in self.start_urls:
-            sku = urlparse(url).path.split('-')[-1]
+        for record in start_records(self):
+            url = record['url']
+            sku = record.get('ean') or urlparse(url).path.split('-')[-1]
             detail_url = self.PRODUCT_DETAIL_BY_SKU.format(sku)
-            yield scrapy.Request(detail_url, self.parse, meta={'sku': sku, 'url': url})
+            yield scrapy.Request(detail_url, self.parse, meta={'sku': sku, 'url': url, 'conditional': True})
 
     def parse(self, response, **kwargs):
+        if response.status == 304:
+            yield not_modified(self, response, response.meta['sku'], response.meta['url'])
+            return
         data = response.json()
-        loader = ItemLoader(item=Product(), response=response)
         sku, url = data.get('sku') or response.meta['sku'], response.meta['url']
-        loader.add_value('link', url)
-        loader.add_value('ean', sku)
-        loader.add_value('title', data['label'])
         detail = data['variants'][0]
-        attributes = detail['attributes']
-        loader.add_value('description', [i['value'] for i in attributes if i['label'].lower() == 'description'])
         price = self.get_price(detail)
         if price is None:
             self.logger.debug('Not found price for url: %s' % url)
             return
-        loader.add_value('price', price)
-        yield from self.categories_filter(loader, data['categories'], sku, url)
+        item = ProductRecord(
+            # the API prices are euro cents, with no currency of their own
+            link=url, ean=sku, title=data['label'], price=price, currency='EUR',
+            description=[i['value'] for i in detail['attributes'] if i['label'].lower() == 'description'],
+        )
+        marker = unchanged_marker(self, sku, url, item)
+        if marker is not None:
+            yield marker
+            return
+        code = self.category_code(data['categories'])
+        if code is None:
+            return
+        # the item can come out of a batched categories response, it keeps the lease of its product
+        item.work_key = response.meta.get('work_key')
+        self.assembler.start(sku, item, ('breadcrumb', 'reviews'), url=url)
+        yield self.reviews_request(sku)
+        yield from self.breadcrumb(code, sku)
 
     @staticmethod
     def get_price(detail: Dict[str, Any]) -> Union[str, None]:
@@ -72,13 +101,11 @@ class ELeclercSpider(scrapy.Spider):
         if price_data is None:
             return
         discount_price = price_data.get('discountPrice')
-        price = str(int(discount_price['totalPrice']['price'] if discount_price else price_data['price']['price']))
-        counter = len(price) // 2
-        if counter == 1:
-            counter = 2
-        return str(int(price) / int(f'1{"".join(["0" for _ in range(counter)])}'))
+        # the API gives integer cents
+        return format_cents(int(discount_price['totalPrice']['price'] if discount_price else price_data['price']['price']))
 
-    def categories_filter(self, loader: ItemLoader, categories: List[Dict[str, Any]], product_id: str, url: str):
+    @staticmethod
+    def category_code(categories: List[Dict[str, Any]]) -> Union[str, None]:
         code, max_level_num = None, 0
         for category_data in categories:
             pass_c = False
@@ -96,50 +123,66 @@ class ELeclercSpider(scrapy.Spider):
                     break
             if pass_c:
                 continue
-        if code is None:
+        return code
+
+    def breadcrumb(self, code: str, sku: str):
+        if code in self.breadcrumbs:
+            yield from self.assembler.deliver(sku, 'breadcrumb', {'breadcrumb': self.breadcrumbs[code]})
             return
-        yield scrapy.Request(
-            self.CATEGORIES_DETAIL.format(code),
+        waiting = self.waiting_breadcrumb.setdefault(code, [])
+        waiting.append(sku)
+        if len(waiting) > 1:
+            return
+        request = self.category_batcher.add(code)
+        if request is not None:
+            yield request
+
+    def categories_request(self, codes: List[str]) -> scrapy.Request:
+        return scrapy.Request(
+            self.CATEGORIES_DETAIL.format(','.join(codes)),
             self.parse_breadcrumb,
-            meta={'loader': loader, 'sku': product_id, 'url': url}
+            meta={'codes': codes},
+            errback=self.categories_errback
         )
 
     def parse_breadcrumb(self, response):
-        data = response.json()
-        if not data:
-            return
-        loader = response.meta['loader']
-        loader.add_value(
-            'breadcrumb', [i['label'] if i['label'] != 'root' else 'Accueil' for i in data[0]['breadcrumb']]
-        )
-        yield scrapy.Request(
-            self.REVIEWS_BY_PRODUCT_SKU.format(response.meta['sku']),
-            self.parse_reviews,
-            meta=response.meta
+        for category in response.json() or []:
+            breadcrumb = [i['label'] if i['label'] != 'root' else 'Accueil' for i in category['breadcrumb']]
+            self.breadcrumbs[category['code']] = breadcrumb
+            for sku in self.waiting_breadcrumb.pop(category['code'], []):
+                yield from self.assembler.deliver(sku, 'breadcrumb', {'breadcrumb': breadcrumb})
+        for code in response.meta['codes']:
+            for sku in self.waiting_breadcrumb.pop(code, []):
+                self.logger.debug('Not found category %s for sku: %s' % (code, sku))
+                yield from self.assembler.fail(sku, 'breadcrumb')
+
+    def categories_errback(self, failure):
+        for code in failure.request.meta['codes']:
+            for sku in self.waiting_breadcrumb.pop(code, []):
+                self.logger.debug('Failed category %s for sku: %s' % (code, sku))
+                yield from self.assembler.fail(sku, 'breadcrumb')
+
+    def reviews_request(self, sku: str) -> scrapy.Request:
+        return self.assembler.request(
+            sku, 'reviews', self.REVIEWS_BY_PRODUCT_SKU.format(sku), self.parse_reviews, errback=self.part_errback
         )
 
     def parse_reviews(self, response):
         data = response.json()
-        loader = response.meta['loader']
-
+        fields = {}
         if data and data.get('includes') and data['includes'].get('productsOrder'):
             data = data['includes']['products'][0]
-            loader.add_value('review_rate', str(data['reviewStatistics']['averageOverallRating']))
-            loader.add_value('review_nb', str(data['reviewStatistics']['totalReviewCount']))
-        self.save_screem(loader, response.meta['url'], response.meta['sku'])
-        yield loader.load_item()
-
-    def save_screem(self, loader: ItemLoader, url: str, sku: str) -> None:
-        screenshot_path = os.path.join(SCREEN_DIR, f'{self.name}_{sku}_{int(datetime.now().timestamp())}.png')
-        options = webdriver.ChromeOptions()
-        options.headless = True
-        driver = webdriver.Chrome(executable_path=CHROME_DRIVER_PATH, options=options)
-        driver.get(url)
-        time.sleep(3)
-        driver.find_element(By.ID, 'onetrust-accept-btn-handler').click()
-        time.sleep(1)
-        scroll_func = lambda X: driver.execute_script('return document.body.parentNode.scroll' + X)
-        driver.set_window_size(1000, scroll_func('Height'))  # May need manual adjustment
-        driver.find_element(By.XPATH, '//body').screenshot(screenshot_path)
-        driver.quit()
-        loader.add_value('screenshot', screenshot_path)
+            fields['review_rate'] = str(data['reviewStatistics']['averageOverallRating'])
+            fields['review_nb'] = str(data['reviewStatistics']['totalReviewCount'])
+        yield from self.assembler.deliver(response.meta['assembly'], response.meta['part'], fields)
+
+    def part_errback(self, failure):
+        meta = failure.request.meta
+        self.logger.debug('Failed %s of sku: %s' % (meta['part'], meta['assembly']))
+        yield from self.assembler.fail(meta['assembly'], meta['part'])
+
+    def assembled(self, assembly: Assembly):
+        screenshot_name = f'{self.name}_{assembly.key}_{int(datetime.now().timestamp())}'
+        assembly.item.screenshot = ScreenshotJob(name=screenshot_name, url=assembly.context['url'])
+        observe(self, 'product_chain', assembly.elapsed())
+        return assembly.item
@@ -1,11 +1,20 @@
-import os
+from typing import Optional
 
 import scrapy
-from scrapy import Selector
-from scrapy.loader import ItemLoader
 
-from ecommerce.items import Product
-from ecommerce.settings import SCREEN_DIR
+from ecommerce.extraction import FieldSpec, Match, ProductSpec, own_text
+from ecommerce.handlers import release_page
+from ecommerce.inputs import start_records
+from ecommerce.items import ProductRecord, ScreenshotJob
+from ecommerce.state import unchanged_marker
+from ecommerce.telemetry import timed
+
+
+def barcode(item) -> Optional[str]:
+    for text in own_text(item):
+        if 'Code barre :' in text:
+            return text.replace('Code barre :', '').strip()
+    return None
 
 
 class JoueclubSpider(scrapy.Spider):
@@ -17,42 +26,52 @@ class JoueclubSpider(scrapy.Spider):
     custom_settings = {
         "DOWNLOAD_DELAY": 0.25,
         "DOWNLOAD_HANDLERS": {
-            "http": "scrapy_playwright.handler.ScrapyPlaywrightDownloadHandler",
-            "https": "scrapy_playwright.handler.ScrapyPlaywrightDownloadHandler",
-        },
-        "TWISTED_REACTOR": "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
+            "http": "ecommerce.handlers.SharedBrowserDownloadHandler",
+            "https": "ecommerce.handlers.SharedBrowserDownloadHandler",
+        }
     }
+    PRODUCT_SPEC = ProductSpec(
+        FieldSpec('ean', Match('li', parent=Match('ul', equals={'class': 'list list-dash mt-0'})), extract=barcode),
+        FieldSpec('title', Match('p', equals={'class': 'c-product-header__title'})),
+        FieldSpec('price', Match('span', equals={'class': 'c-product-price__price-value'})),
+        FieldSpec('description', Match('div', equals={'data-ng-if': "information.key === 'jcp_description'"})),
+        FieldSpec('breadcrumb', Match('span', ancestor=Match('ul', equals={'class': 'breadcrumb'})), many=True),
+    )
 
     def start_requests(self):
-        for url in self.start_urls:
+        for record in start_records(self):
             yield scrapy.Request(
-                url,
+                record['url'],
                 self.parse,
                 meta={
                     'playwright': True,
                     "playwright_include_page": True
-                }
+                },
+                errback=self.errback
             )
 
     async def parse(self, response, **kwargs):
         page = response.meta["playwright_page"]
-        html = await page.content()
-        sel = Selector(text=html)
-        loader = ItemLoader(item=Product(), selector=sel)
-        loader.add_value('link', response.url)
-        list_li = sel.xpath('//ul[@class="list list-dash mt-0"]/li/text()').getall()
-        sku = None
-        for i in list_li:
-            if 'Code barre :' in i:
-                sku = i.replace('Code barre :', '').strip()
-                break
-        loader.add_value('ean', sku)
-        loader.add_xpath('title', '//p[@class="c-product-header__title"]')
-        loader.add_xpath('price', '//span[@class="c-product-price__price-value"]')
-        loader.add_xpath('description', '//div[@data-ng-if="information.key === \'jcp_description\'"]')
-        loader.add_xpath('breadcrumb', '//ul[@class="breadcrumb"]//span')
-        screenshot_path = os.path.join(SCREEN_DIR, f'{self.name}_{sku}.png')
-        await page.screenshot(path=screenshot_path, full_page=True)
-        loader.add_value('screenshot', screenshot_path)
-        await page.close()
-        yield loader.load_item()
+        try:
+            with timed(self, 'page_content'):
+                html = await page.content()
+            item = ProductRecord(link=response.url)
+            with timed(self, 'extract'):
+                sku = self.PRODUCT_SPEC.populate(item, html).get('ean', [None])[0]
+            marker = unchanged_marker(self, sku, response.url, item)
+        except Exception:
+            # an unreleased page would hold its slot of PLAYWRIGHT_MAX_PAGES for good
+            await release_page(page)
+            raise
+        if marker is not None:
+            await release_page(page)
+            yield marker
+            return
+        item.screenshot = ScreenshotJob(name=f'{self.name}_{sku}', page=page)
+        yield item
+
+    async def errback(self, failure):
+        # a failed download closed its page already, an HTTP error still has it
+        page = failure.request.meta.get("playwright_page")
+        if page is not None:
+            await release_page(page)
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Mapping, Optional, Tuple
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.python import to_unicode
+
+from ecommerce.items import ProductUnchanged
+
+# fields every spider knows before its sub-requests and screenshot
+HASHED_FIELDS = ('title', 'price', 'description')
+
+
+def content_hash(values: Mapping[str, Any]) -> str:
+    data = json.dumps([values.get(name) for name in HASHED_FIELDS], default=str)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+class ProductStateStore:
+    """Last seen state of every (spider, EAN) kept in SQLite between the weekly runs.
+
+    Every write is committed at once: the crawlers of ``scrapy crawlall``, and the workers of a
+    queue, each open the file, and a write transaction left open would lock the others out.
+    """
+
+    def __init__(self, path: str, refresh_days: float = 28):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.refresh_secs = refresh_days * 24 * 3600
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # a commit in WAL mode then only appends to the log, the checkpoints sync it
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS products ('
+            'spider TEXT, ean TEXT, price TEXT, title TEXT, review_nb TEXT, content_hash TEXT, '
+            'scraped_at REAL, seen_at REAL, currency TEXT, PRIMARY KEY (spider, ean))'
+        )
+        if 'currency' not in {column[1] for column in self.db.execute('PRAGMA table_info(products)')}:
+            # a store written before the currency was kept
+            self.db.execute('ALTER TABLE products ADD COLUMN currency TEXT')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS validators (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT)'
+        )
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            settings.get('INCREMENTAL_DB'),
+            refresh_days=settings.getfloat('INCREMENTAL_REFRESH_DAYS', 28),
+        )
+
+    def get(self, spider: str, ean: str) -> Optional[dict]:
+        cursor = self.db.execute('SELECT * FROM products WHERE spider = ? AND ean = ?', (spider, ean))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def fresh(self, spider: str, ean: str) -> Optional[dict]:
+        """The stored product if it was fully scraped recently enough to be skipped when unchanged"""
+        row = self.get(spider, ean)
+        if row is None or time.time() - row['scraped_at'] >= self.refresh_secs:
+            return None
+        return row
+
+    def unchanged(self, spider: str, ean: str, values: Mapping[str, Any]) -> bool:
+        row = self.fresh(spider, ean)
+        return row is not None and row['content_hash'] == content_hash(values)
+
+    def save(self, spider: str, ean: str, values: Mapping[str, Any]) -> None:
+        now = time.time()
+        self.db.execute(
+            'INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (spider, ean, values.get('price'), values.get('title'), values.get('review_nb'),
+             content_hash(values), now, now, values.get('currency'))
+        )
+        self.db.commit()
+
+    def touch(self, spider: str, ean: str) -> None:
+        self.db.execute('UPDATE products SET seen_at = ? WHERE spider = ? AND ean = ?', (time.time(), spider, ean))
+        self.db.commit()
+
+    def validators(self, url: str) -> Tuple[Optional[str], Optional[str]]:
+        row = self.db.execute('SELECT etag, last_modified FROM validators WHERE url = ?', (url,)).fetchone()
+        return row or (None, None)
+
+    def save_validators(self, url: str, etag: Optional[str], last_modified: Optional[str]) -> None:
+        self.db.execute('INSERT OR REPLACE INTO validators VALUES (?, ?, ?)', (url, etag, last_modified))
+        self.db.commit()
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def unchanged_marker(spider, ean: str, link: str, values: Mapping[str, Any]) -> Optional[ProductUnchanged]:
+    """The marker to yield instead of the sub-requests and screenshot of a product seen as is before"""
+    state = getattr(spider, 'product_state', None)
+    if state is None or not ean or not state.unchanged(spider.name, ean, values):
+        return None
+    return ProductUnchanged(link=link, ean=ean)
+
+
+def not_modified(spider, response, ean: str, link: str):
+    """Answer a 304: the marker if the stored product is fresh, otherwise the request without validators"""
+    if spider.product_state.fresh(spider.name, ean):
+        return ProductUnchanged(link=link, ean=ean)
+    request = response.request
+    headers = request.headers.copy()
+    headers.pop('If-None-Match', None)
+    headers.pop('If-Modified-Since', None)
+    # a real 200 this time: no 304 handled, nor one read back from the cache
+    statuses = [status for status in request.meta.get('handle_httpstatus_list', ()) if status != 304]
+    meta = {**request.meta, 'conditional': False, 'dont_cache': True, 'handle_httpstatus_list': statuses}
+    return request.replace(headers=headers, meta=meta, dont_filter=True)
+
+
+class IncrementalCrawl:
+    """Opens the state store for the crawl and exposes it as ``spider.product_state``"""
+
+    def __init__(self, settings):
+        if not settings.getbool('INCREMENTAL_ENABLED'):
+            raise NotConfigured
+        self.settings = settings
+        self.store = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        extension = cls(crawler.settings)
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        self.store = ProductStateStore.from_settings(self.settings)
+        spider.product_state = self.store
+
+    def spider_closed(self, spider):
+        if self.store is not None:
+            self.store.close()
+
+
+class ConditionalRequestsMiddleware:
+    """Sends ``If-None-Match``/``If-Modified-Since`` for requests flagged with the ``conditional`` meta key.
+
+    A 304 reaches the spider callback, which decides whether the stored product can stand for it.
+    """
+
+    def process_request(self, request, spider):
+        state = getattr(spider, 'product_state', None)
+        if state is None or not request.meta.get('conditional'):
+            return
+        etag, last_modified = state.validators(request.url)
+        if etag:
+            request.headers.setdefault('If-None-Match', etag)
+        if last_modified:
+            request.headers.setdefault('If-Modified-Since', last_modified)
+        if etag or last_modified:
+            request.meta['handle_httpstatus_list'] = request.meta.get('handle_httpstatus_list', []) + [304]
+
+    def process_response(self, request, response, spider):
+        state = getattr(spider, 'product_state', None)
+        if state is None or not request.meta.get('conditional') or response.status != 200:
+            return response
+        etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+        if etag or last_modified:
+            state.save_validators(
+                request.url,
+                to_unicode(etag) if etag else None,
+                to_unicode(last_modified) if last_modified else None,
+            )
+        return response
@@ -0,0 +1,71 @@
+import json
+import logging
+from typing import Any, Dict, Iterator, List, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+GTIN_KEYS = ('gtin13', 'gtin', 'gtin14', 'gtin12', 'gtin8')
+
+
+def iter_json_ld(selector) -> Iterator[Dict[str, Any]]:
+    """Yield the JSON-LD objects embedded in the page, flattening lists and ``@graph`` containers"""
+    for text in selector.xpath('//script[@type="application/ld+json"]/text()').getall():
+        try:
+            data = json.loads(text)
+        except ValueError:
+            logger.debug('Skipping invalid JSON-LD block')
+            continue
+        for obj in data if isinstance(data, list) else [data]:
+            if not isinstance(obj, dict):
+                continue
+            for child in obj.get('@graph', []):
+                if isinstance(child, dict):
+                    yield child
+            yield obj
+
+
+def is_type(obj: Dict[str, Any], name: str) -> bool:
+    types = obj.get('@type')
+    return name in types if isinstance(types, list) else types == name
+
+
+def product_fields(selector) -> Dict[str, Any]:
+    """Map the schema.org ``Product`` and ``BreadcrumbList`` of a page to ``Product`` fields.
+
+    Only the fields found are returned, so the caller can tell what is missing.
+    """
+    fields = {}
+    for obj in iter_json_ld(selector):
+        if is_type(obj, 'Product') and 'title' not in fields:
+            fields['title'] = obj.get('name')
+            fields['description'] = obj.get('description')
+            fields['ean'] = next((obj[key] for key in GTIN_KEYS if obj.get(key)), None)
+            fields['price'], fields['currency'] = offer_price(obj.get('offers'))
+            rating = obj.get('aggregateRating') or {}
+            fields['review_rate'] = rating.get('ratingValue')
+            fields['review_nb'] = rating.get('reviewCount') or rating.get('ratingCount')
+        elif is_type(obj, 'BreadcrumbList') and 'breadcrumb' not in fields:
+            fields['breadcrumb'] = breadcrumb_names(obj)
+    return {key: str(value) if isinstance(value, (int, float)) else value
+            for key, value in fields.items() if value not in (None, '', [])}
+
+
+def offer_price(offers) -> Tuple[Any, Any]:
+    """Price and currency of the first offer"""
+    if isinstance(offers, list):
+        offers = offers[0] if offers else None
+    if not isinstance(offers, dict):
+        return None, None
+    return offers.get('price') or offers.get('lowPrice'), offers.get('priceCurrency')
+
+
+def breadcrumb_names(obj: Dict[str, Any]) -> List[str]:
+    elements = sorted(obj.get('itemListElement') or [], key=lambda i: int(i.get('position') or 0))
+    names = []
+    for element in elements:
+        item = element.get('item')
+        name = element.get('name') or (item.get('name') if isinstance(item, dict) else None)
+        if name:
+            names.append(name)
+    return names
@@ -0,0 +1,222 @@
+import bisect
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet.error import CannotListenError
+from twisted.web import resource, server
+
+
+logger = logging.getLogger(__name__)
+
+# seconds, from a parsed page to a slow browser navigation
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the ``q`` quantile"""
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Telemetry:
+    """Per spider and stage latency histograms, and counters, of every crawler of the process"""
+
+    def __init__(self):
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = defaultdict(float)
+        self.gauges: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self.started: Dict[str, float] = {}
+
+    def observe(self, spider: str, stage: str, seconds: float) -> None:
+        histogram = self.histograms.get((spider, stage))
+        if histogram is None:
+            histogram = self.histograms[(spider, stage)] = Histogram()
+        histogram.observe(seconds)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        lines = ['# TYPE ecommerce_stage_seconds histogram']
+        for (spider, stage), histogram in sorted(self.histograms.items()):
+            labels = f'spider="{spider}",stage="{stage}"'
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'ecommerce_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'ecommerce_stage_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f'ecommerce_stage_seconds_sum{{{labels}}} {histogram.sum:.6f}')
+            lines.append(f'ecommerce_stage_seconds_count{{{labels}}} {histogram.count}')
+        for kind, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+            for name in sorted({name for name, _ in metrics}):
+                lines.append(f'# TYPE ecommerce_{name} {kind}')
+                for (metric, labels), value in sorted(metrics.items()):
+                    if metric == name:
+                        text = ','.join(f'{key}="{label}"' for key, label in labels)
+                        lines.append(f'ecommerce_{name}{{{text}}} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, spider: str) -> List[str]:
+        lines = []
+        for (name, stage), histogram in sorted(self.histograms.items()):
+            if name == spider and histogram.count:
+                lines.append(
+                    f'{stage}: {histogram.count} x {histogram.sum / histogram.count * 1000:.0f}ms avg, '
+                    f'p50 <= {histogram.quantile(0.5)}s, p95 <= {histogram.quantile(0.95)}s, '
+                    f'total {histogram.sum:.1f}s'
+                )
+        return lines
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, telemetry: Telemetry):
+        super().__init__()
+        self.telemetry = telemetry
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4')
+        return self.telemetry.render().encode()
+
+
+class TelemetryExtension:
+    """Records the crawl in the process wide ``Telemetry`` and serves it on ``TELEMETRY_PORT``.
+
+    Download latency is recorded per callback, as ``navigation/<callback>`` for Playwright
+    requests and ``download/<callback>`` otherwise; the spiders and pipelines add their own
+    stages with ``timed``/``observe`` through ``spider.telemetry``. Playwright pages opened,
+    still open and idle in the page pool are followed from the handler stats, the pages still
+    held by a request, item or screenshot when the spider closes are reported as leaks.
+    """
+    telemetry = Telemetry()
+    listening = None
+    users = 0
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('TELEMETRY_ENABLED'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.port = settings.getint('TELEMETRY_PORT', 9410)
+        self.host = settings.get('TELEMETRY_HOST', '127.0.0.1')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        extension = cls(crawler)
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(extension.response_received, signal=signals.response_received)
+        crawler.signals.connect(extension.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(extension.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(extension.spider_error, signal=signals.spider_error)
+        return extension
+
+    def spider_opened(self, spider):
+        spider.telemetry = self.telemetry
+        self.telemetry.started[spider.name] = time.time()
+        cls = TelemetryExtension
+        cls.users += 1
+        if cls.listening is None and self.port:
+            from twisted.internet import reactor
+            try:
+                cls.listening = reactor.listenTCP(self.port, server.Site(MetricsResource(self.telemetry)),
+                                                  interface=self.host)
+            except CannotListenError as e:
+                logger.warning('No metrics endpoint: %s', e)
+            else:
+                logger.info('Metrics on http://%s:%i/metrics', self.host, self.port)
+
+    def response_received(self, response, request, spider):
+        callback = getattr(request.callback, '__name__', 'parse')
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            kind = 'navigation' if request.meta.get('playwright') else 'download'
+            self.telemetry.observe(spider.name, f'{kind}/{callback}', latency)
+        self.telemetry.inc('responses_total', spider=spider.name, status=str(response.status))
+        self._pages(spider)
+
+    def item_scraped(self, item, response, spider):
+        self.telemetry.inc('items_total', spider=spider.name, type=type(item).__name__)
+        self._throughput(spider)
+
+    def item_dropped(self, item, response, exception, spider):
+        self.telemetry.inc('items_dropped_total', spider=spider.name)
+
+    def spider_error(self, failure, response, spider):
+        self.telemetry.inc('spider_errors_total', spider=spider.name)
+
+    def spider_closed(self, spider, reason):
+        self._throughput(spider)
+        opened, in_use = self._pages(spider)
+        for line in self.telemetry.summary(spider.name):
+            logger.info(line, extra={'spider': spider})
+        logger.info('%i items at %.1f/min, %i Playwright pages opened',
+                    self.crawler.stats.get_value('item_scraped_count', 0, spider=spider),
+                    self.telemetry.gauges.get(('items_per_minute', (('spider', spider.name),)), 0), opened,
+                    extra={'spider': spider})
+        if in_use:
+            logger.warning('%i Playwright pages were never given back', in_use, extra={'spider': spider})
+        cls = TelemetryExtension
+        cls.users -= 1
+        if cls.users == 0 and cls.listening is not None:
+            cls.listening.stopListening()
+            cls.listening = None
+
+    def _pages(self, spider) -> Tuple[int, int]:
+        """Pages opened, and pages still held by a request, item or screenshot (not idle in the pool)"""
+        stats = self.crawler.stats
+        opened = stats.get_value('playwright/page_count', 0, spider=spider)
+        open_pages = opened - stats.get_value('playwright/pages/closed', 0, spider=spider)
+        idle = stats.get_value('playwright/pages/idle', 0, spider=spider)
+        self.telemetry.set('pages_opened', opened, spider=spider.name)
+        self.telemetry.set('pages_open', open_pages, spider=spider.name)
+        self.telemetry.set('pages_idle', idle, spider=spider.name)
+        return opened, open_pages - idle
+
+    def _throughput(self, spider) -> None:
+        elapsed = time.time() - self.telemetry.started.get(spider.name, time.time())
+        items = self.crawler.stats.get_value('item_scraped_count', 0, spider=spider)
+        if elapsed > 0:
+            self.telemetry.set('items_per_minute', round(items / elapsed * 60, 1), spider=spider.name)
+
+
+def observe(spider, stage: str, seconds: float) -> None:
+    """Record ``seconds`` spent in ``stage``, when the telemetry is on"""
+    telemetry = getattr(spider, 'telemetry', None)
+    if telemetry is not None:
+        telemetry.observe(spider.name, stage, seconds)
+
+
+@contextmanager
+def timed(spider, stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(spider, stage, time.perf_counter() - start)
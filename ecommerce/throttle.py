@@ -0,0 +1,135 @@
+import logging
+import time
+from collections import deque
+from typing import Optional
+
+from scrapy.exceptions import NotConfigured
+from scrapy.http import TextResponse
+
+from ecommerce.middlewares import CloudFlareMiddleware
+
+
+logger = logging.getLogger(__name__)
+
+
+class DomainStats:
+    """Outcome of the last responses of one downloader slot"""
+
+    def __init__(self, window: int):
+        self.outcomes = deque(maxlen=window)
+        self.latency = None
+        self.best_latency = None
+        self.adjusted_at = time.monotonic()
+
+    def record(self, error: bool, latency: Optional[float] = None) -> None:
+        self.outcomes.append(error)
+        if latency is None:
+            return
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if self.best_latency is None or self.latency < self.best_latency:
+            self.best_latency = self.latency
+
+    @property
+    def error_rate(self) -> float:
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def reset(self) -> None:
+        self.outcomes.clear()
+        self.adjusted_at = time.monotonic()
+
+
+class AdaptiveThrottleMiddleware:
+    """Tunes the concurrency and delay of every downloader slot (one per domain) while crawling.
+
+    429 and 503 responses, Cloudflare challenges and download errors count as errors.
+    Every ``ADAPTIVE_THROTTLE_INTERVAL`` seconds a slot above ``ADAPTIVE_THROTTLE_TARGET_ERROR_RATE``
+    halves its concurrency and doubles its delay. A slot well under the target, with a latency
+    not far above the best seen, first shortens its delay, then takes one more concurrent request.
+    A ``Retry-After`` header is honoured right away.
+    """
+    ERROR_CODES = (429, 503)
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_THROTTLE_ENABLED'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.target = settings.getfloat('ADAPTIVE_THROTTLE_TARGET_ERROR_RATE', 0.05)
+        self.window = settings.getint('ADAPTIVE_THROTTLE_WINDOW', 20)
+        self.interval = settings.getfloat('ADAPTIVE_THROTTLE_INTERVAL', 5.0)
+        self.min_concurrency = settings.getint('ADAPTIVE_THROTTLE_MIN_CONCURRENCY', 1)
+        self.max_concurrency = settings.getint('ADAPTIVE_THROTTLE_MAX_CONCURRENCY', 32)
+        self.min_delay = settings.getfloat('ADAPTIVE_THROTTLE_MIN_DELAY', 0.0)
+        self.max_delay = settings.getfloat('ADAPTIVE_THROTTLE_MAX_DELAY', 30.0)
+        self.latency_factor = settings.getfloat('ADAPTIVE_THROTTLE_LATENCY_FACTOR', 2.0)
+        self.domains = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_response(self, request, response, spider):
+        challenge = isinstance(response, TextResponse) and CloudFlareMiddleware.is_cloudflare_challenge(response)
+        if challenge:
+            self.stats.inc_value('adaptive_throttle/cloudflare_challenges', spider=spider)
+        error = challenge or response.status in self.ERROR_CODES
+        self._record(request, spider, error, request.meta.get('download_latency'))
+        if response.status == 429:
+            self._retry_after(request, response, spider)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self._record(request, spider, True)
+
+    def _slot(self, request):
+        key = request.meta.get('download_slot')
+        return key, self.crawler.engine.downloader.slots.get(key)
+
+    def _record(self, request, spider, error: bool, latency: Optional[float] = None) -> None:
+        key, slot = self._slot(request)
+        if slot is None:
+            return
+        domain = self.domains.get(key)
+        if domain is None:
+            domain = self.domains[key] = DomainStats(self.window)
+        domain.record(error, latency)
+        if error:
+            self.stats.inc_value(f'adaptive_throttle/{key}/errors', spider=spider)
+        if time.monotonic() - domain.adjusted_at >= self.interval and len(domain.outcomes) >= self.window // 2:
+            self._adjust(key, slot, domain, spider)
+
+    def _adjust(self, key, slot, domain: DomainStats, spider) -> None:
+        concurrency, delay = slot.concurrency, slot.delay
+        error_rate = domain.error_rate
+        if error_rate > self.target:
+            slot.concurrency = max(self.min_concurrency, slot.concurrency // 2)
+            slot.delay = min(self.max_delay, max(slot.delay * 2, self.min_delay, 0.5))
+        elif error_rate <= self.target / 2 and not self._slow(domain):
+            if slot.delay > self.min_delay:
+                slot.delay = max(self.min_delay, slot.delay * 0.75 if slot.delay > 0.05 else 0)
+            else:
+                slot.concurrency = min(self.max_concurrency, slot.concurrency + 1)
+        domain.reset()
+        if (concurrency, delay) != (slot.concurrency, slot.delay):
+            logger.debug(
+                'Slot %s: %.0f%% errors, latency %.2fs, concurrency %i -> %i, delay %.2fs -> %.2fs',
+                key, error_rate * 100, domain.latency or 0, concurrency, slot.concurrency, delay, slot.delay,
+                extra={'spider': spider},
+            )
+        self.stats.set_value(f'adaptive_throttle/{key}/concurrency', slot.concurrency, spider=spider)
+        self.stats.set_value(f'adaptive_throttle/{key}/delay', round(slot.delay, 2), spider=spider)
+
+    def _slow(self, domain: DomainStats) -> bool:
+        if domain.latency is None or not domain.best_latency:
+            return False
+        return domain.latency > domain.best_latency * self.latency_factor
+
+    def _retry_after(self, request, response, spider) -> None:
+        value = response.headers.get('Retry-After')
+        if not value or not value.isdigit():
+            return
+        key, slot = self._slot(request)
+        if slot is not None and int(value) > slot.delay:
+            slot.delay = min(self.max_delay, float(value))
+            logger.debug('Slot %s asked to retry after %ss', key, value.decode(), extra={'spider': spider})
@@ -0,0 +1,270 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from scrapy import Request, signals
+from scrapy.exceptions import DontCloseSpider, NotConfigured
+
+from ecommerce.jobs import product_key
+
+
+logger = logging.getLogger(__name__)
+
+
+def worker_id() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class WorkQueue:
+    """Products to crawl shared by the worker processes of a run, in one SQLite file.
+
+    A product is queued once per (spider, EAN), or per url when its EAN is not known. Workers
+    lease a few at a time; a lease not completed within ``lease`` seconds, or given back by its
+    worker, goes back to the queue until it was tried ``max_attempts`` times.
+    """
+
+    def __init__(self, path: str, lease: float = 900, max_attempts: int = 3):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.lease_secs = lease
+        self.max_attempts = max_attempts
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS tasks ('
+            'spider TEXT, key TEXT, url TEXT, ean TEXT, record TEXT, status TEXT, attempts INTEGER, '
+            'worker TEXT, lease_until REAL, done_at REAL, PRIMARY KEY (spider, key))'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS tasks_status ON tasks (spider, status, attempts)')
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            settings.get('WORK_QUEUE'),
+            lease=settings.getfloat('WORK_QUEUE_LEASE', 900),
+            max_attempts=settings.getint('WORK_QUEUE_MAX_ATTEMPTS', 3),
+        )
+
+    @contextmanager
+    def transaction(self):
+        # taken before reading, so two workers never lease the same product
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def enqueue(self, spider: str, records: Iterable[Dict[str, str]]) -> int:
+        added = 0
+        with self.transaction():
+            for record in records:
+                key = record.get('ean') or record['url']
+                added += self.db.execute(
+                    "INSERT OR IGNORE INTO tasks VALUES (?, ?, ?, ?, ?, 'queued', 0, NULL, NULL, NULL)",
+                    (spider, key, record['url'], record.get('ean'), json.dumps(record)),
+                ).rowcount
+        return added
+
+    def lease(self, spider: str, worker: str, size: int) -> List[Tuple[str, Dict[str, str]]]:
+        """Up to ``size`` products for ``worker``, as (key, record)"""
+        now = time.time()
+        with self.transaction():
+            self.db.execute(
+                "UPDATE tasks SET status = 'failed' WHERE spider = ? AND status = 'leased' AND lease_until < ? "
+                "AND attempts >= ?", (spider, now, self.max_attempts)
+            )
+            rows = self.db.execute(
+                "SELECT key, record FROM tasks WHERE spider = ? AND attempts < ? "
+                "AND (status = 'queued' OR (status = 'leased' AND lease_until < ?)) ORDER BY attempts LIMIT ?",
+                (spider, self.max_attempts, now, size),
+            ).fetchall()
+            self.db.executemany(
+                "UPDATE tasks SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE spider = ? AND key = ?",
+                [(worker, now + self.lease_secs, spider, key) for key, _ in rows],
+            )
+        return [(key, json.loads(record)) for key, record in rows]
+
+    def done(self, spider: str, key: str) -> int:
+        return self.db.execute(
+            "UPDATE tasks SET status = 'done', done_at = ? WHERE spider = ? AND key = ? AND status != 'done'",
+            (time.time(), spider, key)
+        ).rowcount
+
+    def release(self, spider: str, worker: str) -> int:
+        """Give the leases of a worker back, they count as attempts"""
+        with self.transaction():
+            self.db.execute(
+                "UPDATE tasks SET status = 'failed' WHERE spider = ? AND worker = ? AND status = 'leased' "
+                "AND attempts >= ?", (spider, worker, self.max_attempts)
+            )
+            return self.db.execute(
+                "UPDATE tasks SET status = 'queued', worker = NULL WHERE spider = ? AND worker = ? "
+                "AND status = 'leased'", (spider, worker)
+            ).rowcount
+
+    def available(self, spider: str) -> int:
+        """Products a worker can lease now"""
+        return self.db.execute(
+            "SELECT COUNT(*) FROM tasks WHERE spider = ? AND attempts < ? "
+            "AND (status = 'queued' OR (status = 'leased' AND lease_until < ?))",
+            (spider, self.max_attempts, time.time()),
+        ).fetchone()[0]
+
+    def outstanding(self, spider: str) -> int:
+        """Products queued, being crawled, or whose lease expired and can be tried again"""
+        return self.db.execute(
+            "SELECT COUNT(*) FROM tasks WHERE spider = ? AND (status = 'queued' "
+            "OR status = 'leased' AND (lease_until >= ? OR attempts < ?))",
+            (spider, time.time(), self.max_attempts),
+        ).fetchone()[0]
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        counts = {}
+        for spider, status, count in self.db.execute(
+                'SELECT spider, status, COUNT(*) FROM tasks GROUP BY spider, status ORDER BY spider'):
+            counts.setdefault(spider, {})[status] = count
+        return counts
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def leased_records(spider) -> Iterator[Dict[str, str]]:
+    """The records of the spider ``work_queue``, leased ``WORK_QUEUE_BATCH`` at a time as Scrapy asks for them.
+
+    The key of each lease is kept in ``spider.leases`` under the record url, for
+    ``WorkQueueMiddleware`` to find from the start request of the record.
+    """
+    batch = spider.settings.getint('WORK_QUEUE_BATCH', 10)
+    while True:
+        leased = spider.work_queue.lease(spider.name, spider.worker_id, batch)
+        if not leased:
+            return
+        spider.crawler.stats.inc_value('work_queue/leased', len(leased), spider=spider)
+        for key, record in leased:
+            spider.leases[record['url']] = key
+            yield record
+
+
+class WorkQueueMiddleware:
+    """Spider middleware tagging the requests of a leased product with its key in ``meta['work_key']``.
+
+    The start request of a leased record gets the key, and so do the later requests of the same
+    product (see ``product_key``) and the parts of its assembly, so an item is matched to its
+    lease whatever its link or EAN became. It sits closer to the spider than ``ResumableJob``,
+    so the checkpointed requests keep the key.
+    """
+
+    def __init__(self, settings):
+        if not settings.get('WORK_QUEUE'):
+            raise NotConfigured
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings)
+
+    def process_start_requests(self, start_requests, spider):
+        leases = getattr(spider, 'leases', {})
+        for request in start_requests:
+            key = leases.pop(product_key(request), None)
+            if key is not None:
+                # a product given back can come back to the worker that already saw its url
+                request = request.replace(dont_filter=True)
+                request.meta['work_key'] = key
+            yield request
+
+    def process_spider_output(self, response, result, spider):
+        key = response.meta.get('work_key')
+        for output in result:
+            if key is not None and isinstance(output, Request) and 'work_key' not in output.meta \
+                    and ('assembly' in output.meta or product_key(output) == product_key(response.request)):
+                output.meta['work_key'] = key
+            yield output
+
+
+def work_key(item, response) -> Optional[str]:
+    """The lease key of an item: its own for an assembled record, else the one of its response"""
+    key = getattr(item, 'work_key', None)
+    if key is None and response is not None:
+        key = response.meta.get('work_key')
+    return key
+
+
+class DistributedWorker:
+    """Turns the crawl into one worker of the ``WORK_QUEUE`` shared by several processes or hosts.
+
+    The spider start requests come from the queue (see ``start_records``) instead of the inputs,
+    which ``scrapy queue seed`` loads beforehand. An item marks its product done by the lease key
+    ``WorkQueueMiddleware`` put on its requests; when the worker goes idle it gives back the
+    products that ended without an item, takes more through the start requests of the spider,
+    middlewares included, and stays open while other workers hold leases that may come back.
+    The exports of every worker go to the same ``EXPORT_DIR``, ``scrapy build_index`` merges them.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.get('WORK_QUEUE'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.settings = settings
+        self.worker = worker_id()
+        self.queue = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        extension = cls(crawler)
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(extension.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        self.queue = WorkQueue.from_settings(self.settings)
+        spider.work_queue = self.queue
+        spider.worker_id = self.worker
+        spider.leases = {}
+        logger.info('Worker %s of %s', self.worker, self.settings.get('WORK_QUEUE'), extra={'spider': spider})
+
+    def item_scraped(self, item, response, spider):
+        key = work_key(item, response)
+        if key is not None and self.queue.done(spider.name, key):
+            self.crawler.stats.inc_value('work_queue/done', spider=spider)
+
+    def spider_idle(self, spider):
+        # nothing is downloading; a lease still held ended without an item, unless it waits for its parts
+        if len(getattr(spider, 'assembler', ())):
+            raise DontCloseSpider
+        released = self.queue.release(spider.name, self.worker)
+        if released:
+            self.crawler.stats.inc_value('work_queue/released', released, spider=spider)
+        engine = self.crawler.engine
+        if self.queue.available(spider.name):
+            # the start requests of the spider lease as they are read, the engine reads them as usual
+            spider.leases.clear()
+            start_requests = engine.scraper.spidermw.process_start_requests(spider.start_requests(), spider)
+            start_requests.addCallback(self._resume, engine)
+            raise DontCloseSpider
+        if self.queue.outstanding(spider.name):
+            raise DontCloseSpider
+
+    @staticmethod
+    def _resume(start_requests, engine) -> None:
+        engine.slot.start_requests = iter(start_requests)
+        engine.slot.nextcall.schedule()
+
+    def spider_closed(self, spider, reason):
+        self.queue.release(spider.name, self.worker)
+        counts = self.queue.counts().get(spider.name, {})
+        logger.info('Work queue: %s', ', '.join(f'{count} {status}' for status, count in sorted(counts.items())),
+                    extra={'spider': spider})
+        self.queue.close()
@@ -0,0 +1,31 @@
+from scrapy import Request
+from scrapy.settings import Settings
+
+from ecommerce.middlewares import CloudFlareMiddleware
+
+
+def middleware() -> CloudFlareMiddleware:
+    return CloudFlareMiddleware(Settings({'USER_AGENT': 'scrapy'}))
+
+
+def test_cached_clearance_reaches_the_next_requests():
+    cloudflare = middleware()
+    first = Request('https://www.auchan.fr/p/1')
+    clearance = cloudflare.cache.set(cloudflare.key(first), {'cf_clearance': 'token', '__cfduid': 'id'}, 'solver')
+    retry = cloudflare._retry(clearance, first)
+    second = Request('https://www.auchan.fr/p/2')
+    cloudflare.process_request(second, None)
+    for request in (retry, second):
+        assert request.headers['Cookie'] == b'cf_clearance=token; __cfduid=id'
+        assert request.headers['User-Agent'] == b'solver'
+    other = Request('https://www.carrefour.fr/p/1')
+    cloudflare.process_request(other, None)
+    assert b'Cookie' not in other.headers
+
+
+def test_clearance_merges_with_the_cookie_header():
+    cloudflare = middleware()
+    request = Request('https://www.auchan.fr/p/1', headers={'Cookie': 'session=abc; cf_clearance=old'})
+    cloudflare.cache.set(cloudflare.key(request), {'cf_clearance': 'new'}, 'solver')
+    cloudflare.process_request(request, None)
+    assert request.headers['Cookie'] == b'session=abc; cf_clearance=new'
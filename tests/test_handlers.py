@@ -0,0 +1,147 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from scrapy import Request
+from scrapy.utils.test import get_crawler
+
+from ecommerce.handlers import PagePool, SharedBrowserDownloadHandler, release_page
+from ecommerce.telemetry import TelemetryExtension
+
+
+class FakePage:
+    """The parts of a Playwright page the handler and the pool use"""
+
+    def __init__(self, context):
+        self.context = context
+        self.heap = 0
+        self.url = 'about:blank'
+        self.closed = False
+        self.handlers = {}
+
+    def on(self, event, handler):
+        self.handlers.setdefault(event, []).append(handler)
+
+    def is_closed(self):
+        return self.closed
+
+    async def evaluate(self, expression):
+        return self.heap
+
+    async def goto(self, url):
+        self.url = url
+
+    async def close(self):
+        if not self.closed:
+            self.closed = True
+            self.context.pages.remove(self)
+            for handler in self.handlers.get('close', ()):
+                handler()
+
+
+class FakeContext:
+    def __init__(self):
+        self.pages = []
+
+    def on(self, event, handler):
+        pass
+
+    async def new_page(self):
+        page = FakePage(self)
+        self.pages.append(page)
+        return page
+
+
+class FakeBrowser:
+    async def new_context(self, **kwargs):
+        return FakeContext()
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    """Opens a ``SharedBrowserDownloadHandler`` on a fake browser, inside the running event loop"""
+    # the pages are fakes, neither the asyncio reactor nor Playwright is needed
+    monkeypatch.setattr('scrapy_playwright.handler.verify_installed_reactor', lambda path: None)
+
+    def open_handler(crawler=None, max_pages=2, max_uses=3, max_heap=100):
+        crawler = crawler or get_crawler()
+        cls = SharedBrowserDownloadHandler
+        cls.shared_browser = FakeBrowser()
+        cls.shared_pages = asyncio.Semaphore(max_pages)
+        cls.shared_pool = PagePool(max_uses, max_heap)
+        return cls(crawler)
+
+    yield open_handler
+    SharedBrowserDownloadHandler.shared_browser = None
+    SharedBrowserDownloadHandler.shared_pages = None
+    SharedBrowserDownloadHandler.shared_pool = None
+
+
+async def page(handler, context):
+    request = Request(f'https://www.{context}.fr/p', meta={'playwright': True, 'playwright_context': context})
+    page = await handler._create_page(request)
+    page.url = request.url
+    return page
+
+
+def test_pages_are_reused_then_recycled(handler):
+    async def crawl():
+        browser = handler()
+        first = await page(browser, 'auchan')
+        await release_page(first)
+        assert first.url == 'about:blank'
+        assert await page(browser, 'auchan') is first
+        await release_page(first)
+        assert await page(browser, 'auchan') is first
+        await release_page(first)
+        assert first.closed
+        heavy = await page(browser, 'auchan')
+        heavy.heap = 500
+        await release_page(heavy)
+        assert heavy.closed
+        return browser
+
+    browser = asyncio.run(crawl())
+    stats = browser.stats
+    assert stats.get_value('playwright/page_count') == 2
+    assert stats.get_value('playwright/page_pool/reused') == 2
+    assert stats.get_value('playwright/page_pool/recycled/uses') == 1
+    assert stats.get_value('playwright/page_pool/recycled/memory') == 1
+    assert stats.get_value('playwright/pages/closed') == 2
+    assert not browser.page_resources
+
+
+def test_idle_pages_make_room_for_other_sites(handler):
+    async def crawl():
+        browser = handler(max_pages=2)
+        first, second = await page(browser, 'carrefour'), await page(browser, 'carrefour')
+        await release_page(first)
+        await release_page(second)
+        other = await asyncio.wait_for(page(browser, 'joueclub'), 1)
+        assert first.closed and not other.closed
+        await other.close()
+        await release_page(other)
+        assert len(SharedBrowserDownloadHandler.shared_pool) == 1
+        assert SharedBrowserDownloadHandler.shared_pages._value == 1
+        return browser.stats
+
+    stats = asyncio.run(crawl())
+    assert stats.get_value('playwright/page_pool/evicted') == 1
+    assert stats.get_value('playwright/pages/closed') == 2
+
+
+def test_telemetry_reports_pages_not_given_back(handler):
+    crawler = get_crawler(settings_dict={'TELEMETRY_ENABLED': True, 'TELEMETRY_PORT': 0})
+
+    async def crawl():
+        browser = handler(crawler, max_pages=4)
+        given_back, idle, closed, leaked = [await page(browser, 'auchan') for _ in range(4)]
+        await release_page(given_back)
+        await page(browser, 'auchan')
+        await release_page(idle)
+        await closed.close()
+
+    asyncio.run(crawl())
+    extension = TelemetryExtension(crawler)
+    assert extension._pages(SimpleNamespace(name='auchan')) == (4, 2)
+    assert extension.telemetry.gauges[('pages_idle', (('spider', 'auchan'),))] == 1
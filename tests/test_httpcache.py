@@ -0,0 +1,40 @@
+from scrapy import Request, Spider
+from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.http import TextResponse
+from scrapy.utils.test import get_crawler
+
+DETAILS = 'https://www.e.leclerc/api/rest/live-api/product-details-by-sku/3017620422003'
+
+
+def cache_middleware(tmp_path):
+    crawler = get_crawler(Spider, {
+        'HTTPCACHE_ENABLED': True,
+        'HTTPCACHE_STORAGE': 'ecommerce.httpcache.EndpointCacheStorage',
+        'HTTPCACHE_DIR': str(tmp_path),
+        'HTTPCACHE_TTLS': {r'/product-details-by-sku/': 6 * 3600},
+    })
+    spider = crawler._create_spider('e-leclerc')
+    middleware = HttpCacheMiddleware.from_crawler(crawler)
+    middleware.spider_opened(spider)
+    return middleware, spider
+
+
+def test_a_304_is_never_served_to_the_retry_without_validators(tmp_path):
+    middleware, spider = cache_middleware(tmp_path)
+    conditional = Request(DETAILS, headers={'If-None-Match': '"v1"'},
+                          meta={'conditional': True, 'handle_httpstatus_list': [304]})
+    assert middleware.process_request(conditional, spider) is None
+    middleware.process_response(conditional, TextResponse(DETAILS, status=304, request=conditional), spider)
+
+    # as state.not_modified sends it, the stored product being stale
+    retry = conditional.replace(headers={}, meta={**conditional.meta, 'conditional': False}, dont_filter=True)
+    assert middleware.process_request(retry, spider) is None
+    middleware.process_response(retry, TextResponse(DETAILS, status=304, request=retry), spider)
+    assert middleware.process_request(retry, spider) is None
+
+    middleware.process_response(retry, TextResponse(DETAILS, status=200, body=b'{}', request=retry), spider)
+    cached = middleware.process_request(retry, spider)
+    assert (cached.status, cached.body) == (200, b'{}')
+    # the conditional request still goes to the retailer
+    assert middleware.process_request(conditional, spider) is None
+    middleware.spider_closed(spider)
@@ -0,0 +1,28 @@
+import gzip
+
+from ecommerce.inputs import in_shard, iter_records, parse_shard
+
+
+def test_csv_and_jsonl_keys_are_lowercased(tmp_path):
+    csv_path = tmp_path / 'auchan.csv'
+    csv_path.write_text('URL,EAN\nhttps://www.auchan.fr/p/1, 3017620422003\n')
+    jsonl_path = tmp_path / 'auchan.jsonl.gz'
+    with gzip.open(jsonl_path, 'wt') as f:
+        f.write('{"URL": "https://www.auchan.fr/p/1", "EAN": "3017620422003"}\n\n')
+    expected = [{'url': 'https://www.auchan.fr/p/1', 'ean': '3017620422003'}]
+    assert list(iter_records(str(csv_path))) == expected
+    assert list(iter_records(str(jsonl_path))) == expected
+
+
+def test_plain_lines_are_urls(tmp_path):
+    path = tmp_path / 'urls.txt'
+    path.write_text('https://www.joueclub.fr/a.html\n\nhttps://www.joueclub.fr/b.html\n')
+    assert [record['url'] for record in iter_records(str(path))] == [
+        'https://www.joueclub.fr/a.html', 'https://www.joueclub.fr/b.html',
+    ]
+
+
+def test_shards_split_the_records():
+    records = [{'url': f'https://www.auchan.fr/p/{i}'} for i in range(100)]
+    shards = [[record for record in records if in_shard(record, parse_shard(f'{i}/4'))] for i in range(4)]
+    assert sorted(record['url'] for shard in shards for record in shard) == sorted(r['url'] for r in records)
@@ -0,0 +1,29 @@
+from ecommerce.items import ProductRecord
+from ecommerce.normalize import TYPED_FIELDS, currency_code, typed_columns
+
+
+def test_currency_code():
+    assert currency_code('12,99 €') == 'EUR'
+    assert currency_code('$5.00') == 'USD'
+    assert currency_code(' chf ') == 'CHF'
+    assert currency_code('12.99') is None
+    assert currency_code(None) is None
+
+
+def test_record_reads_the_currency_before_the_symbols_are_stripped():
+    record = ProductRecord(price='5,00$')
+    assert (record.price, record.currency) == ('5.00', 'USD')
+    assert ProductRecord(price=['12,99\xa0€']).currency == 'EUR'
+    # the spiders, or the JSON-LD offer, name it when the price does not
+    assert ProductRecord(price='2.49', currency='GBP').currency == 'GBP'
+    assert ProductRecord(price='2.49').currency is None
+
+
+def test_typed_columns_leave_the_currency_to_the_scraped_field():
+    typed = typed_columns({
+        'price': ['5.00', 'n/a'], 'ean': ['4005556261581', None],
+        'review_rate': ['4.6', None], 'review_nb': ['23', None],
+    })
+    assert set(typed) == set(TYPED_FIELDS) and 'currency' not in typed
+    assert typed['price_cents'] == [500, None]
+    assert typed['invalid'] == [None, 'price']
@@ -0,0 +1,53 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from scrapy import Request
+from scrapy.http import HtmlResponse
+from scrapy.spiderloader import SpiderLoader
+from scrapy.utils.project import get_project_settings
+
+PLAYWRIGHT_SPIDERS = ('auchan', 'carrefour', 'joueclub')
+
+
+class BrokenPage:
+    def __init__(self, error=None):
+        self.error = error
+        self.closed = False
+
+    def is_closed(self):
+        return self.closed
+
+    async def content(self):
+        if self.error is not None:
+            raise self.error
+        return '<html><body><h1>Product</h1></body></html>'
+
+    async def close(self):
+        self.closed = True
+
+
+def failing_spec(*args):
+    raise ValueError('malformed EAN')
+
+
+async def consume(callback):
+    return [output async for output in callback]
+
+
+@pytest.mark.parametrize('name', PLAYWRIGHT_SPIDERS)
+@pytest.mark.parametrize('page, spec', [
+    (BrokenPage(RuntimeError('Target page, context or browser has been closed')), None),
+    (BrokenPage(), SimpleNamespace(populate=failing_spec)),
+])
+def test_callback_errors_give_the_page_back(name, page, spec):
+    spider = SpiderLoader.from_settings(get_project_settings()).load(name)()
+    if spec is not None:
+        spider.PRODUCT_SPEC = spec
+    page.closed = False
+    url = 'https://www.example.com/p/3017620422003'
+    request = Request(url, meta={'playwright_page': page, 'gtin': '3017620422003'})
+    response = HtmlResponse(url, body=b'', request=request)
+    with pytest.raises((RuntimeError, ValueError)):
+        asyncio.run(consume(spider.parse(response)))
+    assert page.closed
@@ -0,0 +1,37 @@
+import time
+from types import SimpleNamespace
+
+from scrapy import Request
+from scrapy.http import Response
+
+from ecommerce.state import ProductStateStore, not_modified
+
+
+def test_stores_sharing_a_file_do_not_lock_each_other(tmp_path):
+    # the crawlers of `scrapy crawlall` each open the same state file
+    path = str(tmp_path / 'products.sqlite')
+    first, second = ProductStateStore(path), ProductStateStore(path)
+    started = time.perf_counter()
+    first.save('auchan', '3017620422003', {'title': 'Nutella', 'price': '3.99'})
+    second.save('carrefour', '3017620422003', {'title': 'Nutella', 'price': '4.09'})
+    first.touch('auchan', '3017620422003')
+    second.save_validators('https://www.carrefour.fr/p/nutella', '"etag"', None)
+    assert time.perf_counter() - started < 1
+    assert second.get('auchan', '3017620422003')['price'] == '3.99'
+    assert first.unchanged('carrefour', '3017620422003', {'title': 'Nutella', 'price': '4.09'})
+    first.close()
+    second.close()
+
+
+def test_stale_product_is_asked_again_for_a_real_200(tmp_path):
+    store = ProductStateStore(str(tmp_path / 'products.sqlite'), refresh_days=0)
+    store.save('e-leclerc', '3017620422003', {'title': 'Nutella', 'price': '3.99'})
+    spider = SimpleNamespace(name='e-leclerc', product_state=store)
+    request = Request('https://www.e.leclerc/api/rest/live-api/product-details-by-sku/3017620422003',
+                      headers={'If-None-Match': '"v1"'},
+                      meta={'conditional': True, 'handle_httpstatus_list': [404, 304]})
+    retry = not_modified(spider, Response(request.url, status=304, request=request), '3017620422003', request.url)
+    assert b'If-None-Match' not in retry.headers and retry.dont_filter
+    assert retry.meta['handle_httpstatus_list'] == [404]
+    assert retry.meta['dont_cache'] and not retry.meta['conditional']
+    store.close()
@@ -0,0 +1,48 @@
+import os
+
+from scrapy.http import HtmlResponse
+
+from ecommerce.structured import product_fields
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'fixtures')
+
+
+def fixture(name: str) -> HtmlResponse:
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return HtmlResponse(f'https://www.example.com/{name}', body=f.read())
+
+
+def test_carrefour_json_ld():
+    assert product_fields(fixture('carrefour.html')) == {
+        'title': 'Ketchup HEINZ',
+        'description': 'Tomato Ketchup, flacon souple de 460 g.',
+        'ean': '0000087157215',
+        'price': '2.49',
+        'currency': 'EUR',
+        'review_rate': '4.4',
+        'review_nb': '112',
+        'breadcrumb': ['Accueil', 'Épicerie salée', 'Sauces', 'Ketchup'],
+    }
+
+
+def test_auchan_json_ld():
+    fields = product_fields(fixture('auchan.html'))
+    assert fields['title'] == "GraviTrax Bloc d'action Zipline"
+    assert fields['ean'] == '4005556261581'
+    assert (fields['price'], fields['currency'], fields['review_rate'], fields['review_nb']) == ('12.99', 'EUR', '4.6', '23')
+    assert fields['breadcrumb'] == ['Accueil', 'Jouets', 'Jeux de construction', 'Circuits à billes']
+
+
+def test_page_without_json_ld_has_no_fields():
+    # the spiders then render the page in Playwright
+    assert product_fields(fixture('joueclub.html')) == {}
+
+
+def test_graph_lists_and_offer_lists():
+    body = b'''<script type="application/ld+json">{"@graph": [
+        {"@type": ["Product", "Thing"], "name": "Lego", "gtin": 5702016616354,
+         "offers": [{"lowPrice": 39.9}], "aggregateRating": {"ratingValue": 5, "ratingCount": 3}}]}</script>
+        <script type="application/ld+json">not json</script>'''
+    assert product_fields(HtmlResponse('https://www.example.com/', body=body)) == {
+        'title': 'Lego', 'ean': '5702016616354', 'price': '39.9', 'review_rate': '5', 'review_nb': '3',
+    }
@@ -0,0 +1,114 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from scrapy import Request
+from scrapy.http import Response
+from scrapy.settings import Settings
+
+from ecommerce.items import ProductRecord
+from ecommerce.workqueue import WorkQueue, WorkQueueMiddleware, work_key
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# one worker of the queue given as argument, resumable, crawling through the project settings
+CRAWL = '''
+import json, sys
+from scrapy import Request, Spider
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.project import get_project_settings
+from ecommerce.inputs import start_records
+
+class ShopSpider(Spider):
+    name = 'shop'
+
+    def start_requests(self):
+        for record in start_records(self):
+            yield Request(record['url'], meta={'ean': record['ean']})
+
+    def parse(self, response):
+        # redirected, and the EAN without its leading zeros as to_integer gives it
+        yield {'link': response.url, 'ean': str(int(response.meta['ean'])),
+               'checkpointed': 'job_key' in response.meta}
+
+settings = get_project_settings()
+settings.setdict({
+    'WORK_QUEUE': sys.argv[1], 'WORK_QUEUE_BATCH': 2, 'JOB_RESUME': True, 'JOB_DB': sys.argv[2],
+    'RETRY_ENABLED': False, 'HTTPCACHE_ENABLED': False, 'INCREMENTAL_ENABLED': False, 'TELEMETRY_ENABLED': False,
+    'ITEM_PIPELINES': {}, 'FEEDS': {sys.argv[3]: {'format': 'jsonlines'}},
+    'LOG_LEVEL': 'ERROR', 'TELNETCONSOLE_ENABLED': False,
+}, priority='cmdline')
+process = CrawlerProcess(settings)
+process.crawl(ShopSpider)
+process.start()
+'''
+
+
+class Shop(BaseHTTPRequestHandler):
+    """Input urls redirecting to the product pages, the first visit of /p/3 fails"""
+    visits = []
+
+    def do_GET(self):
+        self.visits.append(self.path)
+        if self.path.startswith('/r/'):
+            self.send_response(302)
+            self.send_header('Location', self.path.replace('/r/', '/p/'))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        failed = self.path == '/p/3' and self.visits.count(self.path) == 1
+        body = b'<html>product</html>'
+        self.send_response(500 if failed else 200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_leased_products_are_done_by_their_key(tmp_path):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Shop)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    queue_path, items_path = str(tmp_path / 'queue.sqlite'), tmp_path / 'items.jl'
+    queue = WorkQueue(queue_path)
+    queue.enqueue('shop', [
+        {'url': f'http://127.0.0.1:{server.server_port}/r/{i}', 'ean': f'00000{i}'} for i in range(5)
+    ])
+    try:
+        result = subprocess.run(
+            [sys.executable, '-c', CRAWL, queue_path, str(tmp_path / 'jobs.sqlite'), items_path.as_uri()],
+            cwd=ROOT, capture_output=True, text=True, timeout=120,
+        )
+    finally:
+        server.shutdown()
+    assert result.returncode == 0, result.stderr
+    items = [json.loads(line) for line in items_path.read_text().splitlines()]
+    assert sorted(item['ean'] for item in items) == ['0', '1', '2', '3', '4']
+    # the product given back was leased again through the start requests, checkpointed like the others
+    assert Shop.visits.count('/p/3') == 2
+    assert all(item['checkpointed'] for item in items)
+    assert queue.counts() == {'shop': {'done': 5}}
+    queue.close()
+
+
+def test_key_follows_the_requests_of_its_product_only():
+    middleware = WorkQueueMiddleware(Settings({'WORK_QUEUE': 'queue.sqlite'}))
+    url = 'https://www.e.leclerc/fp/nutella-3017620422003'
+    request = Request('https://www.e.leclerc/api/details/3017620422003',
+                      meta={'url': url, 'work_key': '3017620422003'})
+    response = Response(request.url, request=request)
+    retry = request.replace(meta={'url': url})
+    part = Request('https://www.e.leclerc/api/reviews/3017620422003', meta={'assembly': '3017620422003'})
+    batch = Request('https://www.e.leclerc/api/categories/a,b', meta={'codes': ['a', 'b']})
+    list(middleware.process_spider_output(response, [retry, part, batch], None))
+    assert retry.meta['work_key'] == part.meta['work_key'] == '3017620422003'
+    assert 'work_key' not in batch.meta
+    # an assembled record comes out of whatever response completed it
+    record = ProductRecord(ean='3017620422003')
+    record.work_key = '3017620422003'
+    assert work_key(record, Response(batch.url, request=batch)) == '3017620422003'